@@ -9,10 +9,13 @@ lilydjwg 修改于 2014-05-26
 本程序遵循 GNU GENERAL PUBLIC LICENSE Version 2 (http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt)
 '''
 
-from struct import unpack, pack
+from struct import unpack, pack, unpack_from, Struct, error as StructError
 import sys
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import threading
 import _socket, mmap
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import re
 import os
 import zlib
@@ -37,6 +40,15 @@ def _ulong2ip(ip):
   '''
   return _socket.inet_ntoa(pack('>L', ip))
 
+def _ips2ulongs(ips):
+  '''点分十进制字符串或 unsigned long 的序列 -> unsigned long 的列表
+  '''
+  dtype = getattr(ips, 'dtype', None)
+  if dtype is not None and dtype.kind in 'iu':
+    # NumPy 整数数组，整体转换
+    return ips.astype('uint32').tolist()
+  return [_ip2ulong(ip) if isinstance(ip, str) else int(ip) for ip in ips]
+
 def _extract_date(s):
     return tuple(int(x) for x in re.findall(r'\d+', s))
 
@@ -79,7 +91,39 @@ class QQWry:
     ip 是 unsigned long 型 ip 地址.
     其它同 x.Lookup(ip).
     '''
+    ipinfo = self[self._search(ip)]
+    if ip > ipinfo[1]:
+      raise LookupError('IP NOT Found.')
+    else:
+      return ipinfo
+
+  def lookup_many(self, ips):
+    '''x.lookup_many(ips) -> [(sip, eip, country, area) 或 None, ...] 批量查找.
+
+    ips 是点分十进制字符串或 unsigned long 型 ip 地址的可迭代对象，也可以是 NumPy 数组.
+    所有 ip 排序后按从小到大的顺序一趟查完，每次二分查找都从上一次的结果开始，
+    落在同一 ip 段的地址只读一次记录. 结果按输入的顺序返回，找不到的为 None.
+    '''
+    ips = _ips2ulongs(ips)
+    ret = [None] * len(ips)
     si = 0
+    ipinfo = None
+    for i in sorted(range(len(ips)), key=ips.__getitem__):
+      ip = ips[i]
+      if ipinfo is None or ip > ipinfo[1]:
+        try:
+          si = self._search(ip, si)
+        except LookupError:
+          continue
+        ipinfo = self[si]
+        if ip > ipinfo[1]:
+          continue
+      ret[i] = ipinfo
+    return ret
+
+  def _search(self, ip, si=0):
+    '''x._search(ip, si=0) -> n 从第si条开始，找到起始 ip 不大于 ip 的最后一条索引.
+    '''
     ei = self.Count
     if ip < self._readIndex(si)[0]:
       raise LookupError('IP NOT Found.')
@@ -92,11 +136,7 @@ class QQWry:
           si = mi
         else:
           ei = mi
-    ipinfo = self[si]
-    if ip > ipinfo[1]:
-      raise LookupError('IP NOT Found.')
-    else:
-      return ipinfo
+    return si
 
   def __str__(self):
     tmp = []
@@ -211,6 +251,405 @@ class MQQWry(QQWry):
     self.f.seek(end + 1)
     return self.f[start:end]
 
+class TQQWry(QQWry):
+  '''
+  线程安全的读取器：将数据库 mmap 到内存，用 unpack_from 按偏移量解码记录，
+  从不移动共享的文件位置，同一个实例可以同时在多个线程（或协程）中使用.
+  '''
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.f = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def __getitem__(self, key):
+    if isinstance(key, int):
+      if key >=0 and key <= self.Count:
+        sip, rp = self._readIndex(key)
+        eip = unpack_from('<L', self.f, rp)[0]
+        country, area = self._readRecAt(rp + 4)
+        if area == ' CZ88.NET':
+          area = ''
+        return ipInfo(sip, eip, country, area)
+      else:
+        raise KeyError('INDEX OUT OF RANGE.')
+    return super().__getitem__(key)
+
+  def _readIndex(self, n):
+    ip, lo, hi = unpack_from('<LHB', self.f, self.indexBaseOffset + 7 * n)
+    return ip, lo | hi << 16
+
+  def _offsetAt(self, pos):
+    '''x._offsetAt(pos) -> unsigned long 读取位于 pos 处长度为3字节的偏移.
+    '''
+    lo, hi = unpack_from('<HB', self.f, pos)
+    return lo | hi << 16
+
+  def _readCStrAt(self, pos):
+    '''x._readCStrAt(pos) -> (str, pos) 读取位于 pos 处的字符串及其后的位置.
+    '''
+    if pos == 0:
+      return 'Unknown', pos
+    end = self.f.find(b'\x00', pos)
+    if end < 0:
+      raise Exception('fail to read C string')
+    return self.f[pos:end].decode(self.charset, errors='replace'), end + 1
+
+  def _readRecAt(self, pos, onlyOne=False):
+    '''x._readRecAt(pos) -> [country, area] 读取位于 pos 处的记录的信息.
+    '''
+    mode = self.f[pos]
+    if mode == 0x01:
+      result = self._readRecAt(self._offsetAt(pos + 1), onlyOne)
+    elif mode == 0x02:
+      result = self._readRecAt(self._offsetAt(pos + 1), True)
+      if not onlyOne:
+        result.append(self._readRecAt(pos + 4, True)[0])
+    else: # string
+      s, pos = self._readCStrAt(pos)
+      result = [s]
+      if not onlyOne:
+        result.append(self._readRecAt(pos, True)[0])
+
+    return result
+
+class CQQWry(MQQWry):
+  '''
+  打开时将整个索引一次性解码到内存中：起始 ip 与结束 ip 各放一个紧凑数组，
+  (country, area) 驻留后只记录编号。查询只需一次 bisect，不再 seek.
+  打开的代价约为遍历一遍数据库，适合大批量查询.
+  '''
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    sips = array('I')
+    eips = array('I')
+    ids = array('I')
+    locs = []
+    loc_ids = {}
+    recs = {}
+
+    f = self.f
+    index = f[self.indexBaseOffset:self.indexBaseOffset + 7 * len(self)]
+    for off in range(0, len(index), 7):
+      sip = unpack_from('<L', index, off)[0]
+      rp = unpack('<L', index[off+4:off+7] + b'\x00')[0]
+      r = recs.get(rp)
+      if r is None:
+        f.seek(rp)
+        eip = unpack('<L', f.read(4))[0]
+        loc = tuple(self._readRec())
+        if loc[1] == ' CZ88.NET':
+          loc = loc[0], ''
+        lid = loc_ids.get(loc)
+        if lid is None:
+          lid = loc_ids[loc] = len(locs)
+          locs.append(loc)
+        r = recs[rp] = eip, lid
+      sips.append(sip)
+      eips.append(r[0])
+      ids.append(r[1])
+
+    self._sips = sips
+    self._eips = eips
+    self._ids = ids
+    self._locs = locs
+    self.f.close()
+    self.f = None
+
+  def _search(self, ip, si=0):
+    i = bisect_right(self._sips, ip, si) - 1
+    if i < 0:
+      raise LookupError('IP NOT Found.')
+    return i
+
+  def __getitem__(self, key):
+    if isinstance(key, int):
+      if key >=0 and key <= self.Count:
+        return ipInfo(self._sips[key], self._eips[key],
+                      *self._locs[self._ids[key]])
+      else:
+        raise KeyError('INDEX OUT OF RANGE.')
+    return super().__getitem__(key)
+
+# 预解码缓存文件的格式：
+#   头部 _cache_header，之后是若干 native 字节序的 uint32 数组：
+#   sips[count] eips[count] ids[count] locs[2*nlocs] stroffs[nstrs+1]
+#   最后是所有已解码、去重并以 UTF-8 编码的字符串拼接而成的 blob.
+#   locs 中每两个数是 (country, area) 的字符串编号，
+#   第 i 个字符串为 blob[stroffs[i]:stroffs[i+1]].
+_cache_magic = b'QQWryC\x00\x01'
+_cache_header = Struct('<8scxxxQQIIII')
+_byteorder = sys.byteorder[0].encode()
+
+def cache_file_name(dbfile=DataFileName):
+  return dbfile + '.cache'
+
+def _read_cache_header(buf):
+  magic, byteorder, mtime, size, *counts = _cache_header.unpack_from(buf)
+  if magic != _cache_magic or byteorder != _byteorder:
+    return None
+  return mtime, size, counts
+
+def cache_is_fresh(dbfile=DataFileName, cachefile=None):
+  '''缓存文件是否存在，并且与数据文件的修改时间和大小一致'''
+  if cachefile is None:
+    cachefile = cache_file_name(dbfile)
+  try:
+    with open(cachefile, 'rb') as f:
+      header = _read_cache_header(f.read(_cache_header.size))
+    st = os.stat(dbfile)
+  except (OSError, StructError):
+    return False
+  return header is not None and header[:2] == (st.st_mtime_ns, st.st_size)
+
+def write_cache(dbfile=DataFileName, cachefile=None):
+  '''将数据文件预解码成可以 mmap 的缓存文件，供 CachedQQWry 使用'''
+  if cachefile is None:
+    cachefile = cache_file_name(dbfile)
+  st = os.stat(dbfile)
+  Q = CQQWry(dbfile)
+
+  str_ids = {}
+  stroffs = array('I', [0])
+  blob = []
+  def str_id(s):
+    i = str_ids.get(s)
+    if i is None:
+      b = s.encode('utf-8')
+      blob.append(b)
+      stroffs.append(stroffs[-1] + len(b))
+      i = str_ids[s] = len(str_ids)
+    return i
+
+  locs = array('I')
+  for country, area in Q._locs:
+    locs.append(str_id(country))
+    locs.append(str_id(area))
+  blob = b''.join(blob)
+
+  data = b''.join((
+    _cache_header.pack(
+      _cache_magic, _byteorder, st.st_mtime_ns, st.st_size,
+      len(Q), len(Q._locs), len(str_ids), len(blob)),
+    Q._sips.tobytes(), Q._eips.tobytes(), Q._ids.tobytes(),
+    locs.tobytes(), stroffs.tobytes(), blob,
+  ))
+  safe_overwrite(cachefile, data, mode='wb')
+
+class _CachedLocs:
+  '''缓存文件中的 (country, area) 表'''
+  def __init__(self, locs, stroffs, blob):
+    self.locs = locs
+    self.stroffs = stroffs
+    self.blob = blob
+
+  def _str(self, i):
+    return str(self.blob[self.stroffs[i]:self.stroffs[i+1]], 'utf-8')
+
+  def __getitem__(self, i):
+    return self._str(self.locs[2*i]), self._str(self.locs[2*i+1])
+
+  def __len__(self):
+    return len(self.locs) // 2
+
+class CachedQQWry(CQQWry):
+  '''
+  从 write_cache 生成的缓存文件中读取预先解码的数据，直接 mmap 使用，
+  不再解析 GBK 字符串和重定向. 多个进程（包括 fork 出来的子进程）共享同一份页缓存.
+
+  缓存文件不存在，或者与数据文件的修改时间、大小不一致时，会先重新生成.
+  '''
+  def __init__(self, dbfile=DataFileName, cachefile=None):
+    if cachefile is None:
+      cachefile = cache_file_name(dbfile)
+    if not cache_is_fresh(dbfile, cachefile):
+      write_cache(dbfile, cachefile)
+
+    with open(cachefile, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.f = None
+    self.charset = 'utf-8'
+
+    count, nlocs, nstrs, bloblen = _read_cache_header(self._mm)[2]
+    self.Count = count - 1
+    mv = memoryview(self._mm)
+    pos = _cache_header.size
+    def take(n):
+      nonlocal pos
+      r = mv[pos:pos + 4 * n].cast('I')
+      pos += 4 * n
+      return r
+    self._sips = take(count)
+    self._eips = take(count)
+    self._ids = take(count)
+    locs = take(2 * nlocs)
+    stroffs = take(nstrs + 1)
+    self._locs = _CachedLocs(locs, stroffs, mv[pos:pos + bloblen])
+
+class RangeCache:
+  '''
+  查询结果的缓存，放在任意 QQWry 实例之前. 以 ip 所在的 ip 段为键，
+  同一段中的不同 ip 都能命中同一条缓存. 找不到的 ip 不缓存.
+
+  maxsize 为最多缓存的 ip 段数，至少为 1；policy 为淘汰策略：'lru' 淘汰最久未使用的，
+  'fifo' 淘汰最早加入的. hits, misses, evictions 为计数器，stats() 返回全部统计.
+  其它属性与方法转给被缓存的实例.
+  '''
+  def __init__(self, qqwry, maxsize=4096, policy='lru'):
+    if policy not in ('lru', 'fifo'):
+      raise ValueError('unknown eviction policy: %r' % policy)
+    if maxsize < 1:
+      raise ValueError('maxsize must be at least 1, got %r' % maxsize)
+    self.qqwry = qqwry
+    self.maxsize = maxsize
+    self.policy = policy
+    self._lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    with self._lock:
+      self._cache = OrderedDict()
+      self._sips = []
+      self.hits = self.misses = self.evictions = 0
+
+  def Lookup(self, ip):
+    return self.nLookup(_ip2ulong(ip))
+
+  def nLookup(self, ip):
+    with self._lock:
+      ipinfo = self._get(ip)
+    if ipinfo is not None:
+      return ipinfo
+
+    ipinfo = self.qqwry.nLookup(ip)
+    with self._lock:
+      self._put(ipinfo)
+    return ipinfo
+
+  def lookup_many(self, ips):
+    '''同 QQWry.lookup_many. 先查缓存，未命中的 ip 一次批量交给被缓存的实例查找.
+    '''
+    ips = _ips2ulongs(ips)
+    ret = [None] * len(ips)
+    missed = []
+    with self._lock:
+      for i, ip in enumerate(ips):
+        ret[i] = self._get(ip)
+        if ret[i] is None:
+          missed.append(i)
+    if not missed:
+      return ret
+
+    infos = self.qqwry.lookup_many([ips[i] for i in missed])
+    with self._lock:
+      for i, ipinfo in zip(missed, infos):
+        ret[i] = ipinfo
+        if ipinfo is not None:
+          self._put(ipinfo)
+    return ret
+
+  def _get(self, ip):
+    '''查缓存并计数，未命中返回 None. 调用者须持有 _lock'''
+    i = bisect_right(self._sips, ip) - 1
+    if i >= 0:
+      ipinfo = self._cache[self._sips[i]]
+      if ip <= ipinfo[1]:
+        self.hits += 1
+        if self.policy == 'lru':
+          self._cache.move_to_end(ipinfo[0])
+        return ipinfo
+    self.misses += 1
+    return None
+
+  def _put(self, ipinfo):
+    '''加入缓存，必要时淘汰一条. 调用者须持有 _lock'''
+    sip = ipinfo[0]
+    if sip not in self._cache:
+      if len(self._cache) >= self.maxsize:
+        old, _ = self._cache.popitem(last=False)
+        del self._sips[bisect_left(self._sips, old)]
+        self.evictions += 1
+      insort(self._sips, sip)
+    self._cache[sip] = ipinfo
+
+  def __getitem__(self, key):
+    if isinstance(key, str):
+      return self.Lookup(key).normalize()
+    return self.qqwry[key]
+
+  def __getattr__(self, name):
+    return getattr(self.qqwry, name)
+
+  def __len__(self):
+    return len(self.qqwry)
+
+  def __str__(self):
+    return str(self.qqwry)
+
+  def stats(self):
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        'size': len(self._cache),
+        'maxsize': self.maxsize,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': self.hits / total if total else 0.0,
+      }
+
+def benchmark(dbfile=DataFileName, n=100000, classes=None):
+  '''比较各实现查询 n 个随机 ip 的耗时，打开数据库的时间单独计算'''
+  import random
+  import time
+
+  if classes is None:
+    classes = (QQWry, MQQWry, TQQWry, CQQWry, CachedQQWry)
+  ips = [random.getrandbits(32) for _ in range(n)]
+  for cls in classes:
+    t0 = time.perf_counter()
+    Q = cls(dbfile)
+    t1 = time.perf_counter()
+    for ip in ips:
+      try:
+        Q.nLookup(ip)
+      except LookupError:
+        pass
+    t2 = time.perf_counter()
+    print('%-11s open: %8.2f ms, %d lookups: %8.2f ms (%.0f/s)' % (
+      cls.__name__, (t1 - t0) * 1000, n, (t2 - t1) * 1000,
+      n / (t2 - t1)))
+
+def benchmark_threads(dbfile=DataFileName, n=100000, threads=(1, 2, 4, 8),
+                      cls=TQQWry):
+  '''多个线程共用同一个实例查询 n 个随机 ip，比较不同线程数下的吞吐量'''
+  import random
+  import time
+  from concurrent.futures import ThreadPoolExecutor
+
+  Q = cls(dbfile)
+  ips = [random.getrandbits(32) for _ in range(n)]
+  expected = Q.lookup_many(ips)
+
+  def work(part):
+    ret = []
+    for ip in part:
+      try:
+        ret.append(Q.nLookup(ip))
+      except LookupError:
+        ret.append(None)
+    return ret
+
+  for t in threads:
+    parts = [ips[i::t] for i in range(t)]
+    with ThreadPoolExecutor(t) as executor:
+      t0 = time.perf_counter()
+      results = list(executor.map(work, parts))
+      t1 = time.perf_counter()
+    for i, r in enumerate(results):
+      if r != expected[i::t]:
+        raise AssertionError('%s returned wrong results with %d threads' % (
+          cls.__name__, t))
+    print('%s %d thread(s): %8.2f ms (%.0f/s)' % (
+      cls.__name__, t, (t1 - t0) * 1000, n / (t1 - t0)))
 
 def decipher_data(key, data):
   h = bytearray()
@@ -265,6 +704,7 @@ def update(q):
 
     os.chdir(old_d)
     safe_overwrite(DataFileName, d, mode='wb')
+    write_cache(DataFileName)
     old_c = Q and Q.Count or 0
     Q = MQQWry()
     if q != 2:
@@ -285,6 +725,16 @@ def main():
                       help='更新数据库时，没有更新则不输出内容')
   parser.add_argument('-Q', '--more-quiet', action='store_true', default=False,
                       help='更新数据库时总是不输出内容')
+  parser.add_argument('-c', '--compiled', action='store_true', default=False,
+                      help='预先将整个索引解码到内存（查询大量IP时更快）')
+  parser.add_argument('-C', '--cached', action='store_true', default=False,
+                      help='使用预解码的缓存文件（必要时先生成）')
+  parser.add_argument('-b', '--batch', action='store_true', default=False,
+                      help='从标准输入读取IP（每行一个）批量查询')
+  parser.add_argument('--thread-benchmark', metavar='N', type=int,
+                      help='用 N 个随机IP测试多线程共用一个实例时的查询速度')
+  parser.add_argument('--benchmark', metavar='N', type=int,
+                      help='用 N 个随机IP比较各种实现的查询速度')
 
   args = parser.parse_args()
 
@@ -297,7 +747,20 @@ def main():
     update(q)
     return
 
-  Q = MQQWry()
+  if args.benchmark:
+    benchmark(n=args.benchmark)
+    return
+
+  if args.thread_benchmark:
+    benchmark_threads(n=args.thread_benchmark)
+    return
+
+  if args.cached:
+    Q = CachedQQWry()
+  elif args.compiled:
+    Q = CQQWry()
+  else:
+    Q = MQQWry()
   if args.all:
     try:
       for i in Q: #遍历示例代码
@@ -306,6 +769,16 @@ def main():
       pass
     return
 
+  if args.batch:
+    ips = [l.strip() for l in sys.stdin]
+    ips = [ip for ip in ips if ip]
+    for ip, r in zip(ips, Q.lookup_many(ips)):
+      if r is None:
+        print(ip.ljust(16), 'NOT Found')
+      else:
+        print(ip.ljust(16), ''.join(r[2:]))
+    return
+
   ips = args.IP
   if not ips:
     print(Q)
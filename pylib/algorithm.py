@@ -52,6 +52,74 @@ Step Description
 
 difference = LevenshteinDistance
 
+class DeletionIndex:
+  '''对称删除索引，用于查找与给定串编辑距离不超过 k 的所有串
+
+每个串删去至多 max_distance 个字符后得到的所有串都作为键记录下来。
+若两串的编辑距离不超过 k，则它们各删去至多 k 个字符后必有相同的结果，
+所以查询时只需用 LevenshteinDistance 检验这些键下的少数候选串。
+适合较短的串（如输入法编码）；k 大于 max_distance 时退化为逐个比较。
+可以逐个添加、删除。'''
+
+  def __init__(self, items=(), max_distance=2):
+    self.max_distance = max_distance
+    self.items = set()
+    self.index = {}
+    for i in items:
+      self.add(i)
+
+  @staticmethod
+  def deletes(s, k):
+    '''s 删去至多 k 个字符后得到的所有串'''
+    ret = {s}
+    level = {s}
+    for _ in range(k):
+      level = {x[:i] + x[i+1:] for x in level for i in range(len(x))}
+      ret |= level
+    return ret
+
+  def add(self, item):
+    '''添加 item，返回是否为新添加的'''
+    if item in self.items:
+      return False
+    self.items.add(item)
+    index = self.index
+    for d in self.deletes(item, self.max_distance):
+      index.setdefault(d, set()).add(item)
+    return True
+
+  def remove(self, item):
+    '''删除 item，返回它原来是否存在'''
+    if item not in self.items:
+      return False
+    self.items.remove(item)
+    index = self.index
+    for d in self.deletes(item, self.max_distance):
+      s = index[d]
+      s.discard(item)
+      if not s:
+        del index[d]
+    return True
+
+  def search(self, item, k):
+    '''查找与 item 编辑距离不超过 k 的所有串'''
+    if k > self.max_distance:
+      candidates = self.items
+    else:
+      candidates = set()
+      index = self.index
+      for d in self.deletes(item, k):
+        x = index.get(d)
+        if x:
+          candidates |= x
+    return [x for x in candidates if LevenshteinDistance(item, x) <= k]
+
+  def __contains__(self, item):
+    return item in self.items
+
+  def __len__(self):
+    return len(self.items)
+
 def mprint(matrix, width=3):
   '''打印矩阵'''
 
@@ -10,6 +10,10 @@ XXX references to utf-8 need further investigation.
 """
 import struct, os, time, sys, shutil
 import binascii, io, stat
+import mmap
+from array import array
+from fnmatch import fnmatchcase
+from collections.abc import Sequence, Mapping
 
 try:
     import zlib # We may need its compression method
@@ -348,7 +352,9 @@ class ZipInfo (object):
         try:
             return self.filename.encode('ascii'), self.flag_bits
         except UnicodeEncodeError:
-            return self.filename.encode('gb18030'), self.flag_bits | 0x800
+            # GBK names, as Windows tools expect; the UTF-8 flag must not
+            # be set for them
+            return self.filename.encode('gb18030'), self.flag_bits
 
     def _decodeExtra(self):
         # Try to decode the extra field.
@@ -397,7 +403,7 @@ class _ZipDecrypter:
     Usage:
         zd = _ZipDecrypter(mypwd)
         plain_char = zd(cypher_char)
-        plain_text = map(zd, cypher_text)
+        plain_text = zd.decrypt(cypher_text)
     """
 
     def _GenerateCRCTable():
@@ -420,6 +426,18 @@ class _ZipDecrypter:
         return table
     crctable = _GenerateCRCTable()
 
+    def _GenerateStreamTable():
+        """Generate the key stream byte for every possible key2.
+
+        The byte only depends on the low 16 bits of key2.
+        """
+        table = bytearray(65536)
+        for i in range(65536):
+            k = i | 2
+            table[i] = ((k * (k^1)) >> 8) & 255
+        return bytes(table)
+    streamtable = None
+
     def _crc32(self, ch, crc):
         """Compute the CRC32 primitive on one byte."""
         return ((crc >> 8) & 0xffffff) ^ self.crctable[(crc ^ ch) & 0xff]
@@ -445,22 +463,51 @@ class _ZipDecrypter:
         self._UpdateKeys(c)
         return c
 
+    def decrypt(self, data):
+        """Decrypt a whole buffer, returning bytes.
+
+        Same as bytes(map(self, data)), but with the keys kept in local
+        variables and the key stream looked up in a precomputed table.
+        """
+        streamtable = _ZipDecrypter.streamtable
+        if streamtable is None:
+            streamtable = _ZipDecrypter.streamtable = \
+                    _ZipDecrypter._GenerateStreamTable()
+        crctable = self.crctable
+        key0, key1, key2 = self.key0, self.key1, self.key2
+        out = bytearray(len(data))
+        i = 0
+        for c in data:
+            c ^= streamtable[key2 & 0xffff]
+            out[i] = c
+            i += 1
+            key0 = (key0 >> 8) ^ crctable[(key0 ^ c) & 0xff]
+            key1 = ((key1 + (key0 & 0xff)) * 134775813 + 1) & 0xffffffff
+            key2 = (key2 >> 8) ^ crctable[(key2 ^ (key1 >> 24)) & 0xff]
+        self.key0, self.key1, self.key2 = key0, key1, key2
+        return bytes(out)
+
 class ZipExtFile:
     """File-like object for reading an archive member.
        Is returned by ZipFile.open().
+
+       Decompressed data lives in one bytearray that is consumed by moving
+       an offset, raw data is read with readinto() into a fixed buffer, and
+       each decompress call produces at most `decompress_window' bytes, so
+       streaming a member takes linear time and flat memory.
     """
 
-    def __init__(self, fileobj, zipinfo, decrypt=None):
+    # read from compressed files in 64k blocks
+    compreadsize = 64*1024
+    # decompress at most this many bytes at a time
+    decompress_window = 256*1024
+
+    def __init__(self, fileobj, zipinfo, decrypt=None, close_fileobj=False):
         self.fileobj = fileobj
+        self._close_fileobj = close_fileobj
         self.decrypter = decrypt
-        self.bytes_read = 0
-        self.rawbuffer = b''
-        self.readbuffer = b''
-        self.linebuffer = b''
-        self.eof = False
         self.univ_newlines = False
         self.nlSeps = (b"\n", )
-        self.lastdiscard = b''
 
         self.compress_type = zipinfo.compress_type
         self.compress_size = zipinfo.compress_size
@@ -469,10 +516,27 @@ class ZipExtFile:
         self.mode    = "r"
         self.name = zipinfo.filename
 
-        # read from compressed files in 64k blocks
-        self.compreadsize = 64*1024
+        # compressed bytes still in the file; for encrypted files the first
+        # 12 bytes (the encryption header) have been read by ZipFile.open()
+        self._compress_left = self.compress_size
+        if self.decrypter is not None:
+            self._compress_left -= 12
+
+        self._rawbuffer = bytearray(self.compreadsize)
+        self._rawview = memoryview(self._rawbuffer)
+        self._readbuffer = bytearray()
+        self._offset = 0
+        self._unconsumed = b''
+        self.eof = False
+
+        # checked when the end of the member is reached
+        self._expected_crc = getattr(zipinfo, 'CRC', None)
+        self._running_crc = 0
+
         if self.compress_type == ZIP_DEFLATED:
             self.dc = zlib.decompressobj(-15)
+        else:
+            self.dc = None
 
     def set_univ_newlines(self, univ_newlines):
         self.univ_newlines = univ_newlines
@@ -494,67 +558,150 @@ class ZipExtFile:
 
     def close(self):
         self.closed = True
+        if self._close_fileobj:
+            self.fileobj.close()
+
+    def readable(self):
+        return True
+
+    def _fileobj_readinto(self, view):
+        """Read into `view' from the underlying file object, which may not
+           have a readinto() method. Return the number of bytes read.
+        """
+        readinto = getattr(self.fileobj, 'readinto', None)
+        if readinto is not None:
+            return readinto(view)
+        data = self.fileobj.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _read_raw(self):
+        """Read the next block of raw (decrypted) member data.
+           Return None at the end of the member.
+        """
+        n = min(self._compress_left, len(self._rawbuffer))
+        if n <= 0:
+            return None
+        view = self._rawview[:n]
+        got = self._fileobj_readinto(view)
+        if not got:
+            # truncated archive
+            self._compress_left = 0
+            return None
+        self._compress_left -= got
+        data = view[:got]
+
+        # decrypt new data if we were given an object to handle that
+        if self.decrypter is not None:
+            data = self.decrypter.decrypt(data)
+        return data
+
+    def _fill_once(self):
+        """Add the next piece of decompressed data to the read buffer."""
+        if self.eof:
+            return
 
-    def _checkfornewline(self):
-        nl, nllen = -1, -1
-        if self.linebuffer:
-            # ugly check for cases where half of an \r\n pair was
-            # read on the last pass, and the \r was discarded.  In this
-            # case we just throw away the \n at the start of the buffer.
-            if (self.lastdiscard, self.linebuffer[:1]) == (b'\r', b'\n'):
-                self.linebuffer = self.linebuffer[1:]
+        buf = self._readbuffer
+        # drop consumed data; del of a prefix is cheap for bytearray
+        if self._offset and self._offset * 2 >= len(buf):
+            del buf[:self._offset]
+            self._offset = 0
+
+        if self.dc is None:
+            data = self._read_raw()
+            if data is None:
+                self.eof = True
+                self._update_crc(b'', True)
+            else:
+                buf += data
+                self._update_crc(data, False)
+            return
 
-            for sep in self.nlSeps:
-                nl = self.linebuffer.find(sep)
-                if nl >= 0:
-                    nllen = len(sep)
-                    return nl, nllen
+        data = self._unconsumed
+        if not data:
+            data = self._read_raw()
+            if data is None:
+                # we're out of raw bytes; flush just to make sure the
+                # decompressor is done
+                data = self.dc.flush()
+                buf += data
+                self.eof = True
+                self._update_crc(data, True)
+                return
+        data = self.dc.decompress(data, self.decompress_window)
+        buf += data
+        self._unconsumed = self.dc.unconsumed_tail
+        if self.dc.eof:
+            self.eof = True
+        self._update_crc(data, self.eof)
+
+    def _update_crc(self, newdata, eof):
+        """Update the running CRC with `newdata'; at the end of the member
+           compare it with the CRC recorded in the directory.
+        """
+        if self._expected_crc is None:
+            return
+        self._running_crc = crc32(newdata, self._running_crc) & 0xffffffff
+        if eof and self._running_crc != self._expected_crc:
+            raise BadZipfile("Bad CRC-32 for file %r" % self.name)
+
+    def _available(self):
+        return len(self._readbuffer) - self._offset
+
+    def _take(self, n):
+        """Consume and return n bytes from the read buffer."""
+        offset = self._offset
+        data = bytes(self._readbuffer[offset:offset + n])
+        self._offset = offset + n
+        return data
 
-        return nl, nllen
+    def _findnewline(self, start):
+        """Find the next line break at or after `start' bytes into the
+           buffered data. Return (position, length) of the line break,
+           or (-1, 0) if there is none yet.
+        """
+        buf = self._readbuffer
+        offset = self._offset
+        nl = buf.find(b"\n", offset + start)
+        if not self.univ_newlines:
+            return (nl - offset, 1) if nl >= 0 else (-1, 0)
+
+        cr = buf.find(b"\r", offset + start, nl if nl >= 0 else len(buf))
+        if cr < 0:
+            return (nl - offset, 1) if nl >= 0 else (-1, 0)
+        if cr + 1 < len(buf):
+            return cr - offset, 2 if buf[cr + 1] == 0x0a else 1
+        if self.eof:
+            return cr - offset, 1
+        # need the next byte to tell "\r" from "\r\n"
+        return -1, 0
 
     def readline(self, size = -1):
         """Read a line with approx. size. If size is negative,
            read a whole line.
         """
-        if size < 0:
+        if size is None or size < 0:
             size = sys.maxsize
         elif size == 0:
             return b''
 
-        # check for a newline already in buffer
-        nl, nllen = self._checkfornewline()
-
-        if nl >= 0:
-            # the next line was already in the buffer
-            nl = min(nl, size)
-        else:
-            # no line break in buffer - try to read more
-            size -= len(self.linebuffer)
-            while nl < 0 and size > 0:
-                buf = self.read(min(size, 100))
-                if not buf:
-                    break
-                self.linebuffer += buf
-                size -= len(buf)
-
-                # check for a newline in buffer
-                nl, nllen = self._checkfornewline()
-
-            # we either ran out of bytes in the file, or
-            # met the specified size limit without finding a newline,
-            # so return current buffer
-            if nl < 0:
-                s = self.linebuffer
-                self.linebuffer = b''
-                return s
-
-        buf = self.linebuffer[:nl]
-        self.lastdiscard = self.linebuffer[nl:nl + nllen]
-        self.linebuffer = self.linebuffer[nl + nllen:]
-
-        # line is always returned with \n as newline char (except possibly
-        # for a final incomplete line in the file, which is handled above).
-        return buf + b"\n"
+        searched = 0
+        while True:
+            nl, nllen = self._findnewline(searched)
+            available = self._available()
+            if nl >= 0 or available >= size or self.eof:
+                break
+            # a trailing "\r" has to be looked at again
+            searched = max(available - 1, 0)
+            self._fill_once()
+
+        if 0 <= nl < size:
+            # line is always returned with \n as newline char (except
+            # possibly for a final incomplete line in the file)
+            line = self._take(nl)
+            self._offset += nllen
+            return line + b"\n"
+        return self._take(min(size, available))
 
     def readlines(self, sizehint = -1):
         """Return a list with all (following) lines. The sizehint parameter
@@ -572,82 +719,226 @@ class ZipExtFile:
         if size == 0:
             return b''
 
-        # determine read size
-        bytesToRead = self.compress_size - self.bytes_read
+        if size is None or size < 0:
+            chunks = [self._take(self._available())]
+            while not self.eof:
+                self._fill_once()
+                chunks.append(self._take(self._available()))
+            return b''.join(chunks)
 
-        # adjust read size for encrypted files since the first 12 bytes
-        # are for the encryption/password information
-        if self.decrypter is not None:
-            bytesToRead -= 12
-
-        if size is not None and size >= 0:
-            if self.compress_type == ZIP_STORED:
-                lr = len(self.readbuffer)
-                bytesToRead = min(bytesToRead, size - lr)
-            elif self.compress_type == ZIP_DEFLATED:
-                if len(self.readbuffer) > size:
-                    # the user has requested fewer bytes than we've already
-                    # pulled through the decompressor; don't read any more
-                    bytesToRead = 0
-                else:
-                    # user will use up the buffer, so read some more
-                    lr = len(self.rawbuffer)
-                    bytesToRead = min(bytesToRead, self.compreadsize - lr)
-
-        # avoid reading past end of file contents
-        if bytesToRead + self.bytes_read > self.compress_size:
-            bytesToRead = self.compress_size - self.bytes_read
-
-        # try to read from file (if necessary)
-        if bytesToRead > 0:
-            data = self.fileobj.read(bytesToRead)
-            self.bytes_read += len(data)
+        while self._available() < size and not self.eof:
+            self._fill_once()
+        return self._take(min(size, self._available()))
+
+    def readinto(self, b):
+        """Read up to len(b) bytes into b, and return the number of bytes
+           read. Unencrypted stored data goes straight into b.
+        """
+        view = memoryview(b).cast('B')
+        n = len(view)
+        if not n:
+            return 0
+
+        if (not self._available() and self.dc is None
+                and self.decrypter is None and not self.eof):
+            n = min(n, self._compress_left)
+            got = self._fileobj_readinto(view[:n]) if n > 0 else 0
+            if not got:
+                self.eof = True
+                self._compress_left = 0
+                self._update_crc(b'', True)
+                return 0
+            self._compress_left -= got
+            self._update_crc(view[:got], False)
+            return got
+
+        while not self._available() and not self.eof:
+            self._fill_once()
+        n = min(n, self._available())
+        offset = self._offset
+        view[:n] = self._readbuffer[offset:offset + n]
+        self._offset = offset + n
+        return n
+
+
+def _ZipInfoFromCentralDir(data, pos, concat=0):
+    """Build a ZipInfo from the central directory entry at `pos' in `data'.
+    Return the ZipInfo and the size of the entry.
+    """
+    centdir = struct.unpack_from(structCentralDir, data, pos)
+    if centdir[_CD_SIGNATURE] != stringCentralDir:
+        raise BadZipfile("Bad magic number for central directory")
+    pos += sizeCentralDir
+    end = pos + centdir[_CD_FILENAME_LENGTH]
+    filename = data[pos:end]
+    flags = centdir[5]
+    if flags & 0x800:
+        # UTF-8 file names extension
+        filename = filename.decode('utf-8')
+    else:
+        # Historical ZIP filename encoding
+        filename = filename.decode('cp936')
+    # Create ZipInfo instance to store file information
+    x = ZipInfo(filename)
+    pos, end = end, end + centdir[_CD_EXTRA_FIELD_LENGTH]
+    x.extra = data[pos:end]
+    pos, end = end, end + centdir[_CD_COMMENT_LENGTH]
+    x.comment = data[pos:end]
+    x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
+    (x.create_version, x.create_system, x.extract_version, x.reserved,
+        x.flag_bits, x.compress_type, t, d,
+        x.CRC, x.compress_size, x.file_size) = centdir[1:12]
+    x.volume, x.internal_attr, x.external_attr = centdir[15:18]
+    # Convert date/time code to (year, month, day, hour, min, sec)
+    x._raw_time = t
+    x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
+                             t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
+
+    x._decodeExtra()
+    x.header_offset = x.header_offset + concat
+    return x, (sizeCentralDir + centdir[_CD_FILENAME_LENGTH]
+               + centdir[_CD_EXTRA_FIELD_LENGTH]
+               + centdir[_CD_COMMENT_LENGTH])
+
+
+class _LazyDirectory(Sequence):
+    """The central directory of an archive opened with lazy=True.
+
+       Only the position of each entry is kept, in an array; ZipInfo
+       objects are built each time an entry is asked for. Name lookups
+       and prefix searches go through a sorted index of the raw names,
+       one per name encoding, which is built on first use.
+    """
+
+    def __init__(self, data, base, size_cd, concat):
+        self._data = data
+        self._concat = concat
+        self._order = None
+        offsets = self._offsets = array('Q')
+        lengths = struct.Struct('<3H')
+        pos, end = base, base + size_cd
+        while pos < end:
+            if data[pos:pos+4] != stringCentralDir:
+                raise BadZipfile("Bad magic number for central directory")
+            offsets.append(pos)
+            pos += sizeCentralDir + sum(lengths.unpack_from(data, pos + 28))
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return _ZipInfoFromCentralDir(self._data, self._offsets[idx],
+                                      self._concat)[0]
+
+    def _utf8(self, idx):
+        flags = struct.unpack_from('<H', self._data, self._offsets[idx] + 8)
+        return flags[0] & 0x800
+
+    def rawname(self, idx):
+        """The undecoded name of entry `idx', cut at the first null byte
+        as ZipInfo does."""
+        pos = self._offsets[idx]
+        n = struct.unpack_from('<H', self._data, pos + 28)[0]
+        pos += sizeCentralDir
+        name = self._data[pos:pos+n]
+        null_byte = name.find(b'\0')
+        if null_byte >= 0:
+            name = name[:null_byte]
+        return name
+
+    def name(self, idx):
+        """The decoded name of entry `idx'."""
+        return self.rawname(idx).decode('utf-8' if self._utf8(idx) else 'cp936')
+
+    def _index(self):
+        """Entry numbers sorted by raw name, for each encoding."""
+        if self._order is None:
+            groups = {'utf-8': [], 'cp936': []}
+            for i in range(len(self)):
+                groups['utf-8' if self._utf8(i) else 'cp936'].append(i)
+            self._order = [
+                (encoding, array('L', sorted(l, key=self.rawname)))
+                for encoding, l in groups.items() if l]
+        return self._order
+
+    def _bisect(self, order, key):
+        lo, hi = 0, len(order)
+        rawname = self.rawname
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rawname(order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, name):
+        """Return the number of the last entry called `name', or -1."""
+        found = -1
+        for encoding, order in self._index():
             try:
-                self.rawbuffer += data
-            except:
-                print(repr(self.fileobj), repr(self.rawbuffer),
-                      repr(data))
-                raise
-
-            # handle contents of raw buffer
-            if self.rawbuffer:
-                newdata = self.rawbuffer
-                self.rawbuffer = b''
-
-                # decrypt new data if we were given an object to handle that
-                if newdata and self.decrypter is not None:
-                    newdata = bytes(map(self.decrypter, newdata))
-
-                # decompress newly read data if necessary
-                if newdata and self.compress_type == ZIP_DEFLATED:
-                    newdata = self.dc.decompress(newdata)
-                    self.rawbuffer = self.dc.unconsumed_tail
-                    if self.eof and len(self.rawbuffer) == 0:
-                        # we're out of raw bytes (both from the file and
-                        # the local buffer); flush just to make sure the
-                        # decompressor is done
-                        newdata += self.dc.flush()
-                        # prevent decompressor from being used again
-                        self.dc = None
-
-                self.readbuffer += newdata
-
-
-        # return what the user asked for
-        if size is None or len(self.readbuffer) <= size:
-            data = self.readbuffer
-            self.readbuffer = b''
-        else:
-            data = self.readbuffer[:size]
-            self.readbuffer = self.readbuffer[size:]
+                key = name.encode(encoding)
+            except UnicodeEncodeError:
+                continue
+            i = self._bisect(order, key)
+            while i < len(order) and self.rawname(order[i]) == key:
+                found = max(found, order[i])
+                i += 1
+        return found
+
+    def findprefix(self, prefix):
+        """Return the numbers of the entries whose name starts with
+        `prefix', in archive order."""
+        found = []
+        for encoding, order in self._index():
+            try:
+                key = prefix.encode(encoding)
+            except UnicodeEncodeError:
+                continue
+            i = self._bisect(order, key)
+            while i < len(order):
+                raw = self.rawname(order[i])
+                if not raw.startswith(key):
+                    break
+                # a multibyte character may end with what looks like the
+                # first byte of `key', so check the decoded name as well
+                if raw.decode(encoding).startswith(prefix):
+                    found.append(order[i])
+                i += 1
+        found.sort()
+        return found
 
-        return data
+
+class _LazyNameMap(Mapping):
+    """NameToInfo for an archive opened with lazy=True."""
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def __getitem__(self, name):
+        idx = self._directory.find(name)
+        if idx < 0:
+            raise KeyError(name)
+        return self._directory[idx]
+
+    def __contains__(self, name):
+        return self._directory.find(name) >= 0
+
+    def __iter__(self):
+        directory = self._directory
+        return (directory.name(i) for i in range(len(directory)))
+
+    def __len__(self):
+        return len(self._directory)
 
 
 class ZipFile:
     """ Class with methods to open, read, write, close, list zip files.
 
-    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False)
+    z = ZipFile(file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                lazy=False)
 
     file: Either the path to the file, or a file-like object.
           If it is a path, the file will be opened and closed by ZipFile.
@@ -656,15 +947,26 @@ class ZipFile:
     allowZip64: if True ZipFile will create files with ZIP64 extensions when
                 needed, otherwise it will raise an exception when this would
                 be necessary.
+    lazy: if True (mode "r" only) the central directory is mmapped and
+          ZipInfo objects are built only when asked for, which makes
+          opening archives with very many entries cheap. filelist and
+          NameToInfo are then read-only views rather than a list and a
+          dict, and return a new ZipInfo on each access.
 
     """
 
     fp = None                   # Set here since __del__ checks it
+    _cdmap = None
+    # write_many() keeps compressed members bigger than this on disk
+    spool_size = 8 * 1024 * 1024
 
-    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
+    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                 lazy=False):
         """Open the ZIP file with mode read "r", write "w" or append "a"."""
         if mode not in ("r", "w", "a"):
             raise RuntimeError('ZipFile() requires mode "r", "w", or "a"')
+        if lazy and mode != "r":
+            raise RuntimeError('lazy=True requires mode "r"')
 
         if compression == ZIP_STORED:
             pass
@@ -676,6 +978,7 @@ class ZipFile:
             raise RuntimeError("That compression method is not supported")
 
         self._allowZip64 = allowZip64
+        self._lazy = lazy
         self._didModify = False
         self.debug = 0  # Level of printing: 0 through 3
         self.NameToInfo = {}    # Find file info given name
@@ -756,59 +1059,66 @@ class ZipFile:
         # self.start_dir:  Position of start of central directory
         self.start_dir = offset_cd + concat
         fp.seek(self.start_dir, 0)
+        if self._lazy:
+            self._lazy_contents(fp, size_cd, concat)
+            return
         data = fp.read(size_cd)
-        fp = io.BytesIO(data)
         total = 0
         while total < size_cd:
-            centdir = fp.read(sizeCentralDir)
-            if centdir[0:4] != stringCentralDir:
-                raise BadZipfile("Bad magic number for central directory")
-            centdir = struct.unpack(structCentralDir, centdir)
+            x, size = _ZipInfoFromCentralDir(data, total, concat)
             if self.debug > 2:
-                print(centdir)
-            filename = fp.read(centdir[_CD_FILENAME_LENGTH])
-            flags = centdir[5]
-            if flags & 0x800:
-                # UTF-8 file names extension
-                filename = filename.decode('utf-8')
-            else:
-                # Historical ZIP filename encoding
-                filename = filename.decode('cp936')
-            # Create ZipInfo instance to store file information
-            x = ZipInfo(filename)
-            x.extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
-            x.comment = fp.read(centdir[_CD_COMMENT_LENGTH])
-            x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
-            (x.create_version, x.create_system, x.extract_version, x.reserved,
-                x.flag_bits, x.compress_type, t, d,
-                x.CRC, x.compress_size, x.file_size) = centdir[1:12]
-            x.volume, x.internal_attr, x.external_attr = centdir[15:18]
-            # Convert date/time code to (year, month, day, hour, min, sec)
-            x._raw_time = t
-            x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
-                                     t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
-
-            x._decodeExtra()
-            x.header_offset = x.header_offset + concat
+                print(x.filename, x.header_offset)
             self.filelist.append(x)
             self.NameToInfo[x.filename] = x
 
             # update total bytes read from central directory
-            total = (total + sizeCentralDir + centdir[_CD_FILENAME_LENGTH]
-                     + centdir[_CD_EXTRA_FIELD_LENGTH]
-                     + centdir[_CD_COMMENT_LENGTH])
+            total = total + size
 
             if self.debug > 2:
                 print("total", total)
 
-
-    def namelist(self):
-        """Return a list of file names in the archive."""
+    def _lazy_contents(self, fp, size_cd, concat):
+        """Index the central directory without building ZipInfo objects.
+        The directory is mmapped when the file allows it and read into
+        memory otherwise.
+        """
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, OSError, io.UnsupportedOperation):
+            data = fp.read(size_cd)
+            base = 0
+        else:
+            base = self.start_dir
+        directory = _LazyDirectory(data, base, size_cd, concat)
+        if isinstance(data, mmap.mmap):
+            self._cdmap = data
+        self.filelist = directory
+        self.NameToInfo = _LazyNameMap(directory)
+
+    def namelist(self, prefix=None):
+        """Return a list of file names in the archive, only those starting
+        with `prefix' if it is given."""
+        if self._lazy:
+            directory = self.filelist
+            if prefix is None:
+                return [directory.name(i) for i in range(len(directory))]
+            return [directory.name(i) for i in directory.findprefix(prefix)]
         l = []
         for data in self.filelist:
-            l.append(data.filename)
+            if prefix is None or data.filename.startswith(prefix):
+                l.append(data.filename)
         return l
 
+    def glob(self, pattern):
+        """Return the names in the archive matching the shell-style
+        `pattern'. Only names starting with the literal part of `pattern'
+        are looked at."""
+        literal = pattern
+        for c in '*?[':
+            literal = literal.split(c, 1)[0]
+        return [name for name in self.namelist(literal)
+                if fnmatchcase(name, pattern)]
+
     def infolist(self):
         """Return a list of class ZipInfo instances for files in the
         archive."""
@@ -823,18 +1133,102 @@ class ZipFile:
             print("%-46s %s %12d" % (zinfo.filename, date, zinfo.file_size),
                   file=file)
 
-    def testzip(self):
-        """Read all the files and check the CRC."""
-        chunk_size = 2 ** 20
-        for zinfo in self.filelist:
+    def testzip(self, workers=1, report_all=False, headers_only=False):
+        """Read all the files and check the CRC.
+
+           Return the name of the first bad file, or None. If `report_all'
+           is true, return the list of all bad files instead.
+           With `workers' greater than 1 members are checked by that many
+           threads, each reading through its own file handle in chunks, so
+           memory stays bounded whatever the member sizes. This needs the
+           archive to have been opened by file name.
+           If `headers_only' is true, nothing is decompressed; each local
+           file header is only compared with its central directory entry.
+        """
+        if headers_only:
+            check = self._check_local_header
+        else:
+            check = self._check_member
+
+        if workers > 1 and not self._filePassed:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as executor:
+                # map() yields in archive order, so the first bad file
+                # reported is the same as with a single worker
+                results = executor.map(check, self.filelist)
+                bad = [zinfo.filename for zinfo, ok
+                       in zip(self.filelist, results) if not ok]
+        else:
+            bad = []
+            for zinfo in self.filelist:
+                if not check(zinfo):
+                    bad.append(zinfo.filename)
+                    if not report_all:
+                        break
+
+        if report_all:
+            return bad
+        if bad:
+            return bad[0]
+
+    def _check_member(self, zinfo, chunk_size=2 ** 20):
+        """Read the member `zinfo' to its end; return False if it is bad."""
+        try:
+            # Read by chunks, to avoid an OverflowError or a
+            # MemoryError with very large embedded files.
+            f = self.open(zinfo, "r")
             try:
-                # Read by chunks, to avoid an OverflowError or a
-                # MemoryError with very large embedded files.
-                f = self.open(zinfo.filename, "r")
                 while f.read(chunk_size):     # Check CRC-32
                     pass
-            except BadZipfile:
-                return zinfo.filename
+            finally:
+                f.close()
+        except BadZipfile:
+            return False
+        except Exception as e:
+            if zlib is not None and isinstance(e, zlib.error):
+                return False
+            raise
+        return True
+
+    def _check_local_header(self, zinfo):
+        """Compare the local file header of `zinfo' with its central
+           directory entry without reading the member data.
+           Return False if they disagree.
+        """
+        if self._filePassed:
+            fp = self.fp
+        else:
+            fp = io.open(self.filename, 'rb')
+        try:
+            fp.seek(zinfo.header_offset, 0)
+            fheader = fp.read(sizeFileHeader)
+            if (len(fheader) != sizeFileHeader
+                    or fheader[0:4] != stringFileHeader):
+                return False
+            fheader = struct.unpack(structFileHeader, fheader)
+            fname = fp.read(fheader[_FH_FILENAME_LENGTH])
+        finally:
+            if not self._filePassed:
+                fp.close()
+
+        if fname != zinfo.orig_filename.encode("gb18030"):
+            return False
+        if fheader[_FH_COMPRESSION_METHOD] != zinfo.compress_type:
+            return False
+        # with bit 3 set CRC and sizes are in the data descriptor that
+        # follows the data; 0xffffffff means they are in the ZIP64 extra
+        if not fheader[_FH_GENERAL_PURPOSE_FLAG_BITS] & 0x8:
+            for idx, value in ((_FH_CRC, zinfo.CRC),
+                               (_FH_COMPRESSED_SIZE, zinfo.compress_size),
+                               (_FH_UNCOMPRESSED_SIZE, zinfo.file_size)):
+                if (fheader[idx] != 0xffffffff
+                        and fheader[idx] != value & 0xffffffff):
+                    return False
+        # the member data must end before the central directory
+        end = (zinfo.header_offset + sizeFileHeader
+               + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH]
+               + zinfo.compress_size)
+        return end <= self.start_dir
 
     def getinfo(self, name):
         """Return the instance of ZipInfo given 'name'."""
@@ -904,34 +1298,86 @@ class ZipFile:
                 raise RuntimeError("File %s is encrypted, "
                                    "password required for extraction" % name)
 
-            zd = _ZipDecrypter(pwd)
-            # The first 12 bytes in the cypher stream is an encryption header
-            #  used to strengthen the algorithm. The first 11 bytes are
-            #  completely random, while the 12th contains the MSB of the CRC,
-            #  or the MSB of the file time depending on the header type
-            #  and is used to check the correctness of the password.
-            bytes = zef_file.read(12)
-            h = list(map(zd, bytes[0:12]))
-            if zinfo.flag_bits & 0x8:
-                # compare against the file type from extended local headers
-                check_byte = (zinfo._raw_time >> 8) & 0xff
-            else:
-                # compare against the CRC otherwise
-                check_byte = (zinfo.CRC >> 24) & 0xff
-            if h[11] != check_byte:
+            zd = self._check_encryption_header(zinfo, zef_file.read(12), pwd)
+            if zd is None:
+                if not self._filePassed:
+                    zef_file.close()
                 raise RuntimeError("Bad password for file", name)
 
         # build and return a ZipExtFile
+        close_fileobj = not self._filePassed
         if zd is None:
-            zef = ZipExtFile(zef_file, zinfo)
+            zef = ZipExtFile(zef_file, zinfo, close_fileobj=close_fileobj)
         else:
-            zef = ZipExtFile(zef_file, zinfo, zd)
+            zef = ZipExtFile(zef_file, zinfo, zd, close_fileobj=close_fileobj)
 
         # set universal newlines on ZipExtFile if necessary
         if "U" in mode:
             zef.set_univ_newlines(True)
         return zef
 
+    def _check_encryption_header(self, zinfo, header, pwd):
+        """Return a _ZipDecrypter for the member `zinfo', positioned after
+        its 12-byte encryption `header', or None if `pwd' is wrong."""
+        zd = _ZipDecrypter(pwd)
+        # The first 12 bytes in the cypher stream is an encryption header
+        #  used to strengthen the algorithm. The first 11 bytes are
+        #  completely random, while the 12th contains the MSB of the CRC,
+        #  or the MSB of the file time depending on the header type
+        #  and is used to check the correctness of the password.
+        h = zd.decrypt(header[0:12])
+        if zinfo.flag_bits & 0x8:
+            # compare against the file type from extended local headers
+            check_byte = (zinfo._raw_time >> 8) & 0xff
+        else:
+            # compare against the CRC otherwise
+            check_byte = (zinfo.CRC >> 24) & 0xff
+        if len(h) != 12 or h[11] != check_byte:
+            return None
+        return zd
+
+    def checkpassword(self, pwd=None, member=None):
+        """Check a password against the encryption header of `member', or
+        of the first encrypted member, without decrypting any file data.
+        `pwd' defaults to the one given to setpassword(). Return True if
+        the password is accepted or the member is not encrypted.
+        """
+        if pwd is None:
+            pwd = self.pwd
+        if member is None:
+            for zinfo in self.filelist:
+                if zinfo.flag_bits & 0x1:
+                    break
+            else:
+                return True
+        elif isinstance(member, ZipInfo):
+            zinfo = member
+        else:
+            zinfo = self.getinfo(member)
+
+        if not zinfo.flag_bits & 0x1:
+            return True
+        if not pwd:
+            return False
+
+        if self._filePassed:
+            fp = self.fp
+        else:
+            fp = io.open(self.filename, 'rb')
+        try:
+            fp.seek(zinfo.header_offset, 0)
+            fheader = fp.read(sizeFileHeader)
+            if fheader[0:4] != stringFileHeader:
+                raise BadZipfile("Bad magic number for file header")
+            fheader = struct.unpack(structFileHeader, fheader)
+            fp.seek(fheader[_FH_FILENAME_LENGTH]
+                    + fheader[_FH_EXTRA_FIELD_LENGTH], 1)
+            header = fp.read(12)
+        finally:
+            if not self._filePassed:
+                fp.close()
+        return self._check_encryption_header(zinfo, header, pwd) is not None
+
     def extract(self, member, path=None, pwd=None):
         """Extract a member from the archive to the current working directory,
            using its full name. Its file information is extracted as accurately
@@ -946,21 +1392,70 @@ class ZipFile:
 
         return self._extract_member(member, path, pwd)
 
-    def extractall(self, path=None, members=None, pwd=None):
+    def extractall(self, path=None, members=None, pwd=None, workers=1):
         """Extract all members from the archive to the current working
            directory. `path' specifies a different directory to extract to.
            `members' is optional and must be a subset of the list returned
            by namelist().
+           If `workers' is greater than 1, members are extracted concurrently
+           by that many threads, each reading through its own file handle.
+           This needs the archive to have been opened by file name.
         """
         if members is None:
             members = self.namelist()
 
+        if workers > 1 and not self._filePassed:
+            self._extractall_parallel(path, members, pwd, workers)
+            return
+
         for zipinfo in members:
             self.extract(zipinfo, path, pwd)
 
-    def _extract_member(self, member, targetpath, pwd):
-        """Extract the ZipInfo object 'member' to a physical
-           file on the path targetpath.
+    def _extractall_parallel(self, path, members, pwd, workers):
+        """Extract members with a pool of `workers' threads.
+
+           zlib and file I/O release the GIL, so inflating members in
+           threads scales with the number of cores.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if path is None:
+            path = os.getcwd()
+
+        # Later members with the same name overwrite earlier ones, as in
+        # sequential extraction; never write one path from two threads.
+        targets = {}
+        for member in members:
+            if not isinstance(member, ZipInfo):
+                member = self.getinfo(member)
+            targetpath = self._member_path(member, path)
+            targets.pop(targetpath, None)
+            targets[targetpath] = member
+
+        # Create all directories up front so workers don't race on them.
+        dirs = set()
+        for targetpath, member in targets.items():
+            if member.filename[-1] == '/':
+                dirs.add(targetpath)
+            else:
+                dirs.add(os.path.dirname(targetpath))
+        for d in sorted(dirs):
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+
+        # Largest members first, so a big one doesn't finish last alone.
+        files = [(member, targetpath) for targetpath, member in targets.items()
+                 if member.filename[-1] != '/']
+        files.sort(key=lambda x: x[0].file_size, reverse=True)
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(self._write_member, member, targetpath, pwd)
+                       for member, targetpath in files]
+            for future in futures:
+                future.result()
+
+    def _member_path(self, member, targetpath):
+        """Return the path the ZipInfo object 'member' is extracted to
+           under the directory targetpath.
         """
         # build the destination pathname, replacing
         # forward slashes to platform specific separators.
@@ -975,7 +1470,24 @@ class ZipFile:
         else:
             targetpath = os.path.join(targetpath, member.filename)
 
-        targetpath = os.path.normpath(targetpath)
+        return os.path.normpath(targetpath)
+
+    def _write_member(self, member, targetpath, pwd):
+        """Write the contents of the ZipInfo object 'member' to the file
+           targetpath, whose directory must already exist.
+        """
+        source = self.open(member, pwd=pwd)
+        try:
+            with open(targetpath, "wb") as target:
+                shutil.copyfileobj(source, target)
+        finally:
+            source.close()
+
+    def _extract_member(self, member, targetpath, pwd):
+        """Extract the ZipInfo object 'member' to a physical
+           file on the path targetpath.
+        """
+        targetpath = self._member_path(member, targetpath)
 
         # Create all upper directories if necessary.
         upperdirs = os.path.dirname(targetpath)
@@ -987,12 +1499,7 @@ class ZipFile:
                 os.mkdir(targetpath)
             return targetpath
 
-        source = self.open(member, pwd=pwd)
-        target = open(targetpath, "wb")
-        shutil.copyfileobj(source, target)
-        source.close()
-        target.close()
-
+        self._write_member(member, targetpath, pwd)
         return targetpath
 
     def _writecheck(self, zinfo):
@@ -1018,13 +1525,9 @@ class ZipFile:
                 raise LargeZipFile(
                       "Zipfile size would require ZIP64 extensions")
 
-    def write(self, filename, arcname=None, compress_type=None):
-        """Put the bytes from filename into the archive under the name
-        arcname."""
-        if not self.fp:
-            raise RuntimeError(
-                  "Attempt to write to ZIP archive that was already closed")
-
+    def _file_zinfo(self, filename, arcname, compress_type):
+        """Create the ZipInfo for writing file `filename' as `arcname'.
+        Return it and whether `filename' is a directory."""
         st = os.stat(filename)
         isdir = stat.S_ISDIR(st.st_mode)
         mtime = time.localtime(st.st_mtime)
@@ -1046,6 +1549,16 @@ class ZipFile:
 
         zinfo.file_size = st.st_size
         zinfo.flag_bits = 0x00
+        return zinfo, isdir
+
+    def write(self, filename, arcname=None, compress_type=None):
+        """Put the bytes from filename into the archive under the name
+        arcname."""
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+
+        zinfo, isdir = self._file_zinfo(filename, arcname, compress_type)
         zinfo.header_offset = self.fp.tell()    # Start of header bytes
 
         self._writecheck(zinfo)
@@ -1099,6 +1612,115 @@ class ZipFile:
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def write_many(self, paths, compress_type=None, workers=None):
+        """Put several files into the archive, like write() for each.
+
+        `paths' is an iterable of file names or (filename, arcname)
+        pairs. Files are compressed by a pool of `workers' threads
+        (default: the number of CPUs), as zlib releases the GIL, and
+        written to the archive in the order given. At most two files per
+        worker are in flight, and compressed data larger than
+        `spool_size' is kept in temporary files rather than in memory.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        pending = deque()
+        with ThreadPoolExecutor(workers) as executor:
+            try:
+                for path in paths:
+                    if isinstance(path, str):
+                        filename, arcname = path, None
+                    else:
+                        filename, arcname = path
+                    zinfo, isdir = self._file_zinfo(filename, arcname,
+                                                    compress_type)
+                    if isdir:
+                        future = None
+                    else:
+                        future = executor.submit(self._compress_file,
+                                                 filename, zinfo.compress_type)
+                    pending.append((zinfo, future))
+                    if len(pending) > 2 * workers:
+                        self._write_compressed(*pending.popleft())
+                while pending:
+                    self._write_compressed(*pending.popleft())
+            finally:
+                # only non-empty on error: drop the files not started yet
+                # and close the spools of the others
+                for zinfo, future in pending:
+                    if future is None or future.cancel():
+                        continue
+                    try:
+                        future.result()[0].close()
+                    except Exception:
+                        pass
+
+    def _compress_file(self, filename, compress_type):
+        """Compress `filename' into a spooled temporary file. Return it,
+        rewound, with the CRC, the file size and the compressed size."""
+        import tempfile
+
+        out = tempfile.SpooledTemporaryFile(self.spool_size)
+        CRC = file_size = compress_size = 0
+        if compress_type == ZIP_DEFLATED:
+            cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                 zlib.DEFLATED, -15)
+        else:
+            cmpr = None
+        try:
+            with open(filename, "rb") as fp:
+                while 1:
+                    buf = fp.read(64 * 1024)
+                    if not buf:
+                        break
+                    file_size = file_size + len(buf)
+                    CRC = crc32(buf, CRC) & 0xffffffff
+                    if cmpr:
+                        buf = cmpr.compress(buf)
+                    compress_size = compress_size + len(buf)
+                    out.write(buf)
+            if cmpr:
+                buf = cmpr.flush()
+                compress_size = compress_size + len(buf)
+                out.write(buf)
+        except:
+            out.close()
+            raise
+        out.seek(0)
+        return out, CRC, file_size, compress_size
+
+    def _write_compressed(self, zinfo, future):
+        """Append a member compressed by _compress_file(), or a directory
+        if `future' is None."""
+        if future is None:
+            data, zinfo.CRC, zinfo.file_size, zinfo.compress_size = (
+                None, 0, 0, 0)
+        else:
+            (data, zinfo.CRC, zinfo.file_size,
+                zinfo.compress_size) = future.result()
+        try:
+            zinfo.header_offset = self.fp.tell()    # Start of header bytes
+            self._writecheck(zinfo)
+            if zinfo.compress_size > ZIP64_LIMIT and not self._allowZip64:
+                raise LargeZipFile("Filesize would require ZIP64 extensions")
+            self._didModify = True
+            # sizes are known, so FileHeader() adds ZIP64 fields as needed
+            self.fp.write(zinfo.FileHeader())
+            if data is not None:
+                shutil.copyfileobj(data, self.fp, 1024 * 1024)
+        finally:
+            if data is not None:
+                data.close()
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
     def writestr(self, zinfo_or_arcname, data):
         """Write a file into the archive.  The contents is 'data', which
         may be either a 'str' or a 'bytes' instance; if it is a 'str',
@@ -1152,6 +1774,10 @@ class ZipFile:
         if self.fp is None:
             return
 
+        if self._cdmap is not None:
+            self._cdmap.close()
+            self._cdmap = None
+
         if self.mode in ("w", "a") and self._didModify: # write ending records
             count = 0
             pos1 = self.fp.tell()
@@ -1355,6 +1981,50 @@ class PyZipFile(ZipFile):
         return (fname, archivename)
 
 
+def benchmark_extract(filename, workers=(1, 2, 4, 8)):
+    """Time extractall() of `filename' with different numbers of workers."""
+    import tempfile
+
+    zf = ZipFile(filename)
+    total = sum(zinfo.file_size for zinfo in zf.filelist)
+    for n in workers:
+        with tempfile.TemporaryDirectory() as d:
+            t = time.perf_counter()
+            zf.extractall(d, workers=n)
+            t = time.perf_counter() - t
+        print("%d worker(s): %8.3f s %8.1f MB/s" % (n, t, total / t / 1e6))
+    zf.close()
+
+
+def benchmark_decrypt(size=1 << 20):
+    """Compare byte-by-byte and whole-buffer ZipCrypto decryption."""
+    data = os.urandom(size)
+    _ZipDecrypter(b'').decrypt(b'')     # build the key stream table
+    for name, func in (
+            ('per byte', lambda zd: bytes(map(zd, data))),
+            ('buffer', lambda zd: zd.decrypt(data))):
+        zd = _ZipDecrypter(b'password')
+        t = time.perf_counter()
+        func(zd)
+        t = time.perf_counter() - t
+        print("%-8s: %8.3f s %8.2f MB/s" % (name, t, size / t / 1e6))
+
+
+def benchmark_write(paths, workers=(1, 2, 4, 8)):
+    """Time write_many() of `paths' with different numbers of workers."""
+    import tempfile
+
+    total = sum(os.path.getsize(p) for p in paths)
+    for n in workers:
+        with tempfile.TemporaryFile() as f:
+            zf = ZipFile(f, 'w', ZIP_DEFLATED, allowZip64=True)
+            t = time.perf_counter()
+            zf.write_many(paths, workers=n)
+            zf.close()
+            t = time.perf_counter() - t
+        print("%d worker(s): %8.3f s %8.1f MB/s" % (n, t, total / t / 1e6))
+
+
 def main(args = None):
     import textwrap
     USAGE=textwrap.dedent("""\
@@ -1384,7 +2054,8 @@ def main(args = None):
             print(USAGE)
             sys.exit(1)
         zf = ZipFile(args[1], 'r')
-        zf.testzip()
+        for name in zf.testzip(report_all=True):
+            print("Bad file:", name)
         print("Done testing")
 
     elif args[0] == '-e':
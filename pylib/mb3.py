@@ -4,7 +4,12 @@
 '''操作 fcitx 的码表文件（第三版，针对UTF-8版）'''
 import sys
 import struct
+from bisect import bisect_left
+from itertools import groupby
+import heapq
+from operator import attrgetter
 import algorithm
+from myutils import safe_overwrite
 
 version = 0.3
 
@@ -18,6 +23,8 @@ if msg and timeit:
 
 class Record:
   '''一条记录'''
+  __slots__ = ('code', 'hz', 'hit', 'index', 'ispy')
+
   def __init__(self, code, hz, hit=0, index=0, ispy=False):
     self.code = code
     self.hz = hz
@@ -89,16 +96,87 @@ class mbTable:
   拼音长度 = None
   组词规则 = None
   数据 = []
-  编码 = set()
   modified = False
+  # 以下索引在第一次用到时建立，之后随插入、删除一起更新
+  # 与 self.数据 一一对应的编码列表，用于二分查找
+  _编码列表 = None
+  # 汉字 -> 记录列表
+  _汉字索引 = None
+  # 所有不同编码的对称删除索引，用于查找相似编码
+  _编码索引 = None
 
   def __getitem__(self, i):
     '''可以直接通过下标访问某个编码的数据'''
     return self.数据[i]
 
   def __delitem__(self, i):
-    '''也可以直接通过下标来删除'''
-    del self.数据[i]
+    '''也可以直接通过下标或切片来删除'''
+    if isinstance(i, slice):
+      del self.数据[i]
+      self._invalidate()
+    else:
+      self._delete_at(i)
+
+  def _codes(self):
+    '''获取编码列表，必要时建立'''
+    if self._编码列表 is None:
+      self._编码列表 = [r.code for r in self.数据]
+    return self._编码列表
+
+  def _hzindex(self):
+    '''获取汉字索引，必要时建立'''
+    if self._汉字索引 is None:
+      index = {}
+      for r in self.数据:
+        index.setdefault(r.hz, []).append(r)
+      self._汉字索引 = index
+    return self._汉字索引
+
+  def _invalidate(self):
+    '''数据被整体替换了，丢弃所有索引'''
+    self._编码列表 = None
+    self._汉字索引 = None
+    self._编码索引 = None
+
+  def _insert_at(self, pos, record):
+    '''在 pos 处插入记录，并更新索引'''
+    self.数据.insert(pos, record)
+    if self._编码列表 is not None:
+      self._编码列表.insert(pos, record.code)
+    if self._汉字索引 is not None:
+      self._汉字索引.setdefault(record.hz, []).append(record)
+    if self._编码索引 is not None:
+      self._编码索引.add(record.code)
+
+  def _delete_at(self, pos):
+    '''删除 pos 处的记录，并更新索引'''
+    r = self.数据.pop(pos)
+    if self._编码列表 is not None:
+      del self._编码列表[pos]
+    if self._汉字索引 is not None:
+      l = self._汉字索引[r.hz]
+      for i, x in enumerate(l):
+        if x is r:
+          del l[i]
+          break
+      if not l:
+        del self._汉字索引[r.hz]
+    if self._编码索引 is not None and not self.getbycode(r.code):
+      self._编码索引.remove(r.code)
+    return r
+
+  def _find(self, code, hz):
+    '''找出编码为 code、汉字为 hz 的记录，没有时返回 None'''
+    for r in self._hzindex().get(hz, ()):
+      if r.code == code:
+        return r
+
+  def _locate(self, record):
+    '''找出 record 这个对象在 self.数据 中的位置'''
+    pos = self.getpos(record.code)
+    while self.数据[pos] is not record:
+      pos += 1
+    return pos
 
   def __init__(self, file=None):
     '''初始化对象，可选从某个文件载入
@@ -154,7 +232,7 @@ class mbTable:
     c = ''
     for j in a:
       # 分析一次测试用时 0.06x 秒
-      longestHere = -1
+      longestHere = None
       if msg:
         print('分析组词规则...')
         if timeit:
@@ -170,20 +248,21 @@ class mbTable:
       else:
         字 = hz[-int(j[1])]
       # 找出最长的编码；五笔有简码的
+      # 一样长时取排在前面的，即编码较小的
       longest = 0
-      for i in self.search(字):
-        length = len(self[i].code)
-        if length > longest:
+      for r in self._hzindex().get(字, ()):
+        length = len(r.code)
+        if length > longest or (length == longest and r.code < longestHere.code):
           longest = length
-          longestHere = i
+          longestHere = r
       if msg:
         print('分析完毕。')
         if timeit:
           print('用时', datetime.today() - timeitstart)
       try:
-        if longestHere == -1:
+        if longestHere is None:
           raise self.autoCodeError('组词失败，因为我没能找到“%s”的编码' % 字)
-        c += self.数据[longestHere].code[int(j[2])-1]
+        c += longestHere.code[int(j[2])-1]
       except IndexError:
         raise self.autoCodeError('组词失败，因为“%s”的编码太短了' % 字)
 
@@ -193,6 +272,64 @@ class mbTable:
         print('用时', datetime.today() - imeitstart)
     return c
 
+  def batch(self, inserts=(), deletes=(), hits=()):
+    '''批量修改，返回 (插入条数, 删除条数, 更新条数)
+
+inserts 为 (code, hz[, hit[, index[, ispy]]]) 的序列，记录已存在时抛出 RecordExists
+deletes 为 (code, hz) 的序列，记录不存在时抛出 RecordNotExist
+hits    为 (code, hz, hit[, index]) 的序列，更新词频信息，记录不存在时抛出 RecordNotExist
+
+先删除，再更新词频，最后插入。所有检查都在修改之前完成，出错时码表保持不变。
+新记录排序后与原有数据一趟归并，不再逐条在列表中插入、删除'''
+    deleted = {}
+    for code, hz in deletes:
+      r = self._find(code, hz)
+      if r is None or id(r) in deleted:
+        raise self.RecordNotExist(Record(code, hz))
+      deleted[id(r)] = r
+
+    updates = []
+    for code, hz, *info in hits:
+      if not 1 <= len(info) <= 2 or not all(isinstance(x, int) for x in info):
+        raise self.argsError('词频信息应为 (code, hz, hit[, index])，且均为整数')
+      r = self._find(code, hz)
+      if r is None or id(r) in deleted:
+        raise self.RecordNotExist(Record(code, hz))
+      updates.append((r, info))
+
+    new = []
+    seen = set()
+    for item in inserts:
+      t = Record(*item)
+      if not self.maybeCode(t.code):
+        raise self.argsError('不符合当前码表编码的格式')
+      r = self._find(t.code, t.hz)
+      if (r is not None and id(r) not in deleted) or (t.code, t.hz) in seen:
+        raise self.RecordExists(t)
+      seen.add((t.code, t.hz))
+      new.append(t)
+
+    for r, info in updates:
+      r.hit = info[0]
+      if len(info) > 1:
+        r.index = info[1]
+
+    if deleted or new:
+      old = self.数据
+      if deleted:
+        old = (r for r in old if id(r) not in deleted)
+      # 结果与逐条 insert 一样：新记录放在同编码的已有记录之前，
+      # 同编码的新记录中后插入的在前
+      key = attrgetter('code')
+      new.reverse()
+      new.sort(key=key)
+      self.数据[:] = list(heapq.merge(new, old, key=key))
+      self._invalidate()
+
+    if deleted or new or updates:
+      self.modified = True
+    return len(new), len(deleted), len(updates)
+
   def delete(self, code=None, hz=None):
     '''删除指定项，返回删除的条数'''
     count = 0
@@ -200,8 +337,8 @@ class mbTable:
     # 按编码
     if code and not hz:
       pos = self.getpos(code)
-      while self.数据[pos].code == code:
-        del self.数据[pos]
+      while pos < len(self.数据) and self.数据[pos].code == code:
+        self._delete_at(pos)
         count += 1
         # pos = self.getpos(code)
       if count: self.modified = True
@@ -211,10 +348,10 @@ class mbTable:
     # 也可以用 remove，不过这样似乎快一点
     if code and hz:
       pos = self.getpos(code)
-      while self.数据[pos].code == code:
+      while pos < len(self.数据) and self.数据[pos].code == code:
         if self.数据[pos].hz == hz:
           count += 1
-          del self.数据[pos]
+          self._delete_at(pos)
           # 假设没有重复项
           break
         pos += 1
@@ -226,7 +363,7 @@ class mbTable:
       pos = self.search(hz)
       for i in pos:
         # 删一个就少一个
-        del self.数据[i-count]
+        self._delete_at(i-count)
         count += 1
       if count: self.modified = True
       return count
@@ -256,9 +393,17 @@ class mbTable:
 
 record 可以是 Record 对象或者表示编码的字符串'''
     if isinstance(record, Record):
-      return algorithm.二分搜索(self.数据, record)
-    else:
-      return algorithm.二分搜索(self.数据, record, (lambda x, y: x > y.code))
+      record = record.code
+    return bisect_left(self._codes(), record)
+
+  def getbyprefix(self, prefix):
+    '''获取编码以 prefix 开头的数据，用于编码补全'''
+    codes = self._codes()
+    pos = bisect_left(codes, prefix)
+    end = pos
+    while end < len(codes) and codes[end].startswith(prefix):
+      end += 1
+    return self.数据[pos:end]
 
   def getbycode(self, code):
     '''获取 code 对应的数据'''
@@ -288,30 +433,23 @@ record 可以是 Record 对象或者表示编码的字符串'''
 
   def getsimilar(self, code, similar=1):
     '''寻找相似的编码（相似度小于等于 similar 者）'''
-    # 测试用时 (查询编码的长度).x 秒
-
-    # 列出所有编码
-    # 测试用时 0.0x 秒
+    # 编码索引只需建立一次，之后随插入、删除一起更新
     if msg:
       print('查询相似编码...')
       if timeit:
         imeitstart = datetime.today()
-    if not self.编码:
+    if self._编码索引 is None:
       if msg:
-        print('生成编码集合...')
+        print('生成编码索引...')
         if timeit:
           timeitstart = datetime.today()
-      for i in self.数据:
-        self.编码.add(i.code)
+      self._编码索引 = algorithm.DeletionIndex(set(self._codes()))
       if msg:
-        print('编码集合生成完毕。')
+        print('编码索引生成完毕。')
         if timeit:
           print('用时', datetime.today() - timeitstart)
 
-    ret = []
-    for i in self.编码:
-      if algorithm.LevenshteinDistance(code, i) <= similar:
-        ret.append(i)
+    ret = self._编码索引.search(code, similar)
 
     if msg:
       print('相似编码查询完毕。')
@@ -330,16 +468,18 @@ record 可以是 Record 对象或者表示编码的字符串'''
       # 已经存在
       raise self.RecordExists(t)
     except self.RecordNotExist:
-      self.数据.insert(self.getpos(t), t)
+      self._insert_at(self.getpos(t), t)
       self.modified = True
 
-  def load(self, data):
+  def load(self, data, fast=True):
     '''
     从字符串载入数据
 
     此字符串应该来源于码表文件
     通常不需要手动调用此方法
+    fast 为 False 时使用原来逐个字段解析的方式（仅用于比较）
     '''
+    self._invalidate()
     start = 0
 
     # 载入码表属性测试用时 0.001x 秒
@@ -432,7 +572,56 @@ record 可以是 Record 对象或者表示编码的字符串'''
       if timeit:
         timeitstart = datetime.today()
     # 读数据了
-    # 测试用时近两秒
+    if fast:
+      self._load_data(data, start, x)
+    else:
+      self._load_data_legacy(data, start, x)
+    if msg:
+      print('数据载入完成。')
+      if timeit:
+        print('用时', datetime.today() - timeitstart)
+
+  def _load_data(self, data, start, count):
+    '''载入 count 条数据，data[start:] 为第一条数据
+
+    结构体预先编译好，用 unpack_from 直接从 memoryview 的偏移处解析，不再切片和拼格式串'''
+    # XXX 如果没有 版本？
+    codestruct = struct.Struct('<%dsI' % (self.拼音长度+1))
+    if self.版本:
+      tailstruct = struct.Struct('<BII')
+    else:
+      tailstruct = struct.Struct('<II')
+    codeunpack = codestruct.unpack_from
+    codesize = codestruct.size
+    tailunpack = tailstruct.unpack_from
+    tailsize = tailstruct.size
+    hasflag = bool(self.版本)
+    mv = memoryview(data)
+    append = self.数据.append
+
+    for _ in range(count):
+      # 键码，汉字长度
+      code, hzlen = codeunpack(mv, start)
+      start += codesize
+      try:
+        code = code[:code.find(b'\x00')].decode('utf-8')
+      except UnicodeDecodeError:
+        return
+      # 汉字
+      hz = str(mv[start:start+hzlen-1], 'utf-8')
+      start += hzlen
+      # 拼音指示，词频信息
+      if hasflag:
+        ispy, hit, index = tailunpack(mv, start)
+        ispy = bool(ispy)
+      else:
+        hit, index = tailunpack(mv, start)
+        ispy = False
+      start += tailsize
+      append(Record(code, hz, hit, index, ispy))
+
+  def _load_data_legacy(self, data, start, x):
+    '''原来的载入方式，测试用时近两秒'''
     # XXX 如果没有 版本？
     if self.版本:
       fmt2 = '<' + str(self.拼音长度+1) + 's'
@@ -477,10 +666,6 @@ record 可以是 Record 对象或者表示编码的字符串'''
 
       # 添加一个记录
       self.数据.append(Record(code, hz, hit, index, ispy))
-    if msg:
-      print('数据载入完成。')
-      if timeit:
-        print('用时', datetime.today() - timeitstart)
 
   def loadFromTxt(self, txtfile, encoding='utf-8'):
     '''从导出的纯文本文件中导入（不建议使用！）
@@ -492,6 +677,7 @@ record 可以是 Record 对象或者表示编码的字符串'''
 因C++版的程序由于算法有问题导致重复项，考虑导出修改后再导入而写'''
 
     import re
+    self._invalidate()
     with open(txtfile, encoding=encoding) as txt:
       self.版本 = int(re.search(r'0x\d{2}', txt.readline()).group(0), 16)
       l = txt.readline().rstrip()
@@ -529,12 +715,64 @@ record 可以是 Record 对象或者表示编码的字符串'''
         return False
     return True
 
-  def print(self, 文件=None, 词频=False, 编码='utf-8'):
+  def print(self, 文件=None, 词频=False, 编码='utf-8', fast=True, atomic=False):
     '''以纯文本方式输出
 
 如果词频为 False 并且编码为默认的话，所得文件与 mb2txt 程序产生的
-完全一致'''
+完全一致
+
+数据成批格式化后整块写出；atomic 为真时先写到临时文件再改名
+fast 为 False 时使用原来逐行 print 的方式（仅用于比较）'''
+    if not fast:
+      return self._print_legacy(文件, 词频, 编码)
+
+    chunks = self._text_chunks(词频)
+    if not 文件:
+      sys.stdout.writelines(chunks)
+    elif atomic:
+      safe_overwrite(文件, chunks, method='writelines', encoding=编码)
+    else:
+      with open(文件, 'w', encoding=编码) as f:
+        f.writelines(chunks)
+
+  def _text_chunks(self, 词频, chunksize=4096):
+    '''生成文本输出，每次 chunksize 行左右'''
+    lines = [
+      ';fcitx 版本 0x%02x 码表文件' % self.版本,
+      '键码=' + self.键码,
+      '码长=%d' % self.码长,
+    ]
+    if self.拼音长度:
+      lines.append('拼音=@')
+      lines.append('拼音长度=%d' % self.拼音长度)
+    if self.规避字符:
+      lines.append('规避字符=' + self.规避字符)
+    if self.组词规则:
+      lines.append('[组词规则]')
+      lines.extend(self.组词规则)
+    lines.append('[数据]')
 
+    if 词频:
+      fmt = '{0.code} {0.hz} {0.hit} {0.index}'.format
+      pyfmt = '@{0.code} {0.hz} {0.hit} {0.index}'.format
+    else:
+      fmt = '{0.code} {0.hz}'.format
+      pyfmt = '@{0.code} {0.hz}'.format
+    append = lines.append
+    for _, records in groupby(self.数据, key=attrgetter('code')):
+      for r in sorted(records, key=lambda x: -x.index):
+        append(pyfmt(r) if r.ispy else fmt(r))
+      if len(lines) >= chunksize:
+        lines.append('')
+        yield '\n'.join(lines)
+        lines = []
+        append = lines.append
+    if lines:
+      lines.append('')
+      yield '\n'.join(lines)
+
+  def _print_legacy(self, 文件=None, 词频=False, 编码='utf-8'):
+    '''原来逐行 print 的输出方式'''
     # 不打印词频时测试用时 2.5x 秒
     # 打印词频时测试用时 2.7x 秒
     if 文件:
@@ -587,7 +825,7 @@ record 可以是 Record 对象或者表示编码的字符串'''
     '''寻找汉字，返回索引列表，搜寻子串 指示是否要准确匹配
 
 返回结果总是排序过的'''
-    # 精确匹配时测试用时 0.06x 秒
+    # 精确匹配时使用汉字索引，不再遍历数据
     # 模糊匹配时测试用时 0.1x 秒
     if msg:
       print('查询汉字...')
@@ -595,9 +833,7 @@ record 可以是 Record 对象或者表示编码的字符串'''
         timeitstart = datetime.today()
     ret = []
     if not 搜寻子串:
-      for i in range(len(self.数据)):
-        if self.数据[i].hz == hz:
-          ret.append(i)
+      ret = sorted(self._locate(r) for r in self._hzindex().get(hz, ()))
     else:
       for i in range(len(self.数据)):
         if self.数据[i].hz.find(hz) != -1:
@@ -628,8 +864,96 @@ record 可以是 Record 对象或者表示编码的字符串'''
 
   __len__ = size
 
-  def write(self, 文件, 保留词频信息=True):
-    '''保存到文件'''
+  def write(self, 文件, 保留词频信息=True, fast=True, atomic=False):
+    '''保存到文件
+
+数据成批打包后整块写出，与逐个字段写入的结果相同（有无组词规则均是）；
+atomic 为真时先写到临时文件再改名
+fast 为 False 时使用原来逐个字段写入的方式（仅用于比较）'''
+    if not fast:
+      return self._write_legacy(文件, 保留词频信息)
+
+    if msg:
+      print('写入数据中...')
+      if timeit:
+        timeitstart = datetime.today()
+    chunks = self._binary_chunks()
+    if atomic:
+      safe_overwrite(文件, chunks, method='writelines', mode='wb')
+    else:
+      with open(文件, 'wb') as f:
+        f.writelines(chunks)
+    if msg:
+      print('文件写入完成。')
+      if timeit:
+        print('用时', datetime.today() - timeitstart)
+    self.modified = False
+
+  def _binary_chunks(self, chunksize=4096):
+    '''生成码表文件的内容，每次 chunksize 条记录左右'''
+    buf = bytearray()
+    # 版本号
+    if self.版本:
+      buf += struct.pack('<IB', 0, self.版本)
+    else:
+      buf += struct.pack('<I', 1)
+    # 键码字串
+    x = self.键码.encode('utf-8')
+    buf += struct.pack('<I', len(x)) + x + b'\x00'
+    # 码长
+    buf += struct.pack('<B', self.码长)
+    # 拼音长度
+    if self.版本:
+      buf += struct.pack('<B', self.拼音长度)
+    # 规避字符
+    x = self.规避字符.encode('utf-8')
+    buf += struct.pack('<I', len(x)) + x + b'\x00'
+    # 组词规则
+    if self.组词规则: # 有组词规则
+      buf.append(7)
+      for i in range(self.码长-1):
+        rule = self.组词规则[i]
+        buf.append(0 if rule[0] == 'e' else 1)
+        buf.append(int(rule[1]))
+        for j in range(self.码长):
+          x = 3 + j * 4
+          buf.append(0 if rule[x] == 'n' else 1)
+          buf.append(int(rule[x+1]))
+          buf.append(int(rule[x+2]))
+    else:
+      buf.append(0)
+    # 词的数量
+    buf += struct.pack('<I', self.size())
+
+    # XXX 如果没有 版本？
+    size = self.拼音长度 + 1
+    codepack = struct.Struct('<%dsI' % size).pack
+    if self.版本:
+      tailpack = struct.Struct('<BII').pack
+    else:
+      tailpack = None
+      tail2pack = struct.Struct('<II').pack
+    n = 0
+    for i in self.数据:
+      y = i.hz.encode('utf-8') + b'\x00'
+      # 键码，汉字
+      buf += codepack(i.code.encode('utf-8'), len(y))
+      buf += y
+      # 拼音指示，词频信息
+      if tailpack:
+        buf += tailpack(1 if i.ispy else 0, i.hit, i.index)
+      else:
+        buf += tail2pack(i.hit, i.index)
+      n += 1
+      if n >= chunksize:
+        yield bytes(buf)
+        buf.clear()
+        n = 0
+    if buf:
+      yield bytes(buf)
+
+  def _write_legacy(self, 文件, 保留词频信息=True):
+    '''原来逐个字段写入的方式'''
     # 测试用时 3.6x 秒
     f = open(文件, 'wb')
 
@@ -667,8 +991,8 @@ record 可以是 Record 对象或者表示编码的字符串'''
     f.write(struct.pack(fmt, x, 0))
 
     # 组词规则
+    fmt = '<B'
     if self.组词规则: # 有组词规则
-      fmt = '<B'
       f.write(struct.pack(fmt, 7))
       for i in range(self.码长-1):
         if self.组词规则[i][0] == 'e':
@@ -759,3 +1083,82 @@ record 可以是 Record 对象或者表示编码的字符串'''
     def __str__(self):
       return repr(self.value)+' 不存在'
 
+def benchmark_load(file, repeat=3):
+  '''比较新旧两种载入方式的用时与内存占用'''
+  import time
+  import tracemalloc
+
+  with open(file, 'rb') as f:
+    data = f.read()
+  for fast in (False, True):
+    best = None
+    for _ in range(repeat):
+      m = mbTable()
+      m.数据 = []
+      t = time.perf_counter()
+      m.load(data, fast=fast)
+      t = time.perf_counter() - t
+      best = t if best is None else min(best, t)
+    m = mbTable()
+    m.数据 = []
+    tracemalloc.start()
+    m.load(data, fast=fast)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%s: %d records, %.3f s, memory %.1f MiB (peak %.1f MiB)' % (
+      'fast' if fast else 'legacy', m.size(), best,
+      current / 1048576, peak / 1048576))
+
+def benchmark_write(file, repeat=3):
+  '''比较新旧两种方式写出码表文件与文本的用时，并检查两者写出的码表文件相同'''
+  import os
+  import time
+  import tempfile
+
+  m = mbTable()
+  m.数据 = []
+  with open(file, 'rb') as f:
+    m.load(f.read())
+  with tempfile.TemporaryDirectory() as d:
+    out = os.path.join(d, 'out')
+    for name, func in (('write', m.write), ('print', m.print)):
+      outputs = []
+      for fast in (False, True):
+        best = None
+        for _ in range(repeat):
+          t = time.perf_counter()
+          func(out, fast=fast)
+          t = time.perf_counter() - t
+          best = t if best is None else min(best, t)
+        print('%s %s: %d records, %.3f s' % (
+          name, 'fast' if fast else 'legacy', m.size(), best))
+        with open(out, 'rb') as f:
+          outputs.append(f.read())
+      if name == 'write' and outputs[0] != outputs[1]:
+        raise AssertionError('write 的两种方式结果不同')
+
+def benchmark_similar(file, n=20, similar=(1, 2)):
+  '''比较逐个计算编辑距离与使用编码索引查找相似编码的用时'''
+  import random
+  import time
+
+  m = mbTable()
+  m.数据 = []
+  with open(file, 'rb') as f:
+    m.load(f.read())
+  codes = set(m._codes())
+  queries = random.sample(sorted(codes), n)
+
+  t = time.perf_counter()
+  m.getsimilar(queries[0])
+  print('build index: %d codes, %.3f s' % (len(codes), time.perf_counter() - t))
+  for k in similar:
+    t = time.perf_counter()
+    for q in queries:
+      [c for c in codes if algorithm.LevenshteinDistance(q, c) <= k]
+    t1 = (time.perf_counter() - t) / n
+    t = time.perf_counter()
+    for q in queries:
+      m.getsimilar(q, k)
+    t2 = (time.perf_counter() - t) / n
+    print('k=%d: scan %.2f ms, index %.2f ms per query' % (k, t1 * 1000, t2 * 1000))
@@ -5,8 +5,11 @@
 @author: shell.xu
 @modified: lilydjwg
 '''
-import sys, struct, random, logging, io
+import sys, struct, random, logging
 import socket
+import time
+import asyncio
+from collections import OrderedDict
 
 logger = logging.getLogger('dns')
 
@@ -48,6 +51,7 @@ class TYPE(DEFINE):
   TXT = 16    # text strings
   AAAA = 28   # IPv6 AAAA records (RFC 1886)
   SRV = 33    # DNS RR for specifying the location of services (RFC 2782)
+  OPT = 41    # EDNS(0) pseudo-RR (RFC 6891)
   SPF = 99    # TXT RR for Sender Policy Framework
   UNAME = 110
   MP = 240
@@ -78,16 +82,14 @@ def packflag(qr, opcode, auth, truncated, rd, ra, rcode):
   return r
 
 def unpackflag(r):
-  r, qr = unpack(r, 1)
-  r, opcode = unpack(r, 4)
-  r, auth = unpack(r, 1)
-  r, truncated = unpack(r, 1)
-  r, rd = unpack(r, 1)
-  r, ra = unpack(r, 1)
-  r, rv = unpack(r, 3)
-  r, rcode = unpack(r, 4)
-  assert rv == 0
-  return qr, opcode, auth, truncated, rd, ra, rcode
+  # qr, opcode, auth, truncated, rd, ra, rcode; the Z, AD and CD bits are ignored
+  return (r >> 15, r >> 11 & 0xF, r >> 10 & 1, r >> 9 & 1, r >> 8 & 1,
+          r >> 7 & 1, r & 0xF)
+
+_HEADER = struct.Struct('>HHHHHH')
+_QUIZ = struct.Struct('>HH')
+_RR_HEADER = struct.Struct('>HHIH')
+_ADDR_LENGTH = {TYPE.A: 4, TYPE.AAAA: 16}
 
 class Record(object):
 
@@ -111,35 +113,63 @@ class Record(object):
   def packname(self, name):
     return b''.join(bytes((len(i),))+i for i in name.encode('ascii').split(b'.')) + b'\x00'
 
-  def unpackname(self, s):
-    return self._unpackname(s).decode('ascii')
+  def unpackname(self, off):
+    '''decode the name at `off`; return it and the offset after it
 
-  def _unpackname(self, s):
-    r = []
-    c = ord(s.read(1))
-    while c != 0:
-      if c & 0xC0 == 0xC0:
-        c = (c << 8) + ord(s.read(1)) & 0x3FFF
-        r.append(self._unpackname(io.BytesIO(self.buf[c:])))
+    Every suffix decoded is remembered by its offset, so compression
+    pointers into names already seen cost one dict lookup.
+    '''
+    buf, names = self._data, self._names
+    c = buf[off]
+    if c & 0xC0 == 0xC0:
+      # the common case: a pointer to a name decoded before
+      suffix = names.get((c & 0x3F) << 8 | buf[off + 1])
+      if suffix is not None:
+        return suffix, off + 2
+    labels, starts = [], []
+    end = None
+    limit = off
+    while True:
+      c = buf[off]
+      if c == 0:
+        suffix = ''
         break
-      else: r.append(s.read(c))
-      c = ord(s.read(1))
-    return b'.'.join(r)
+      if c & 0xC0 == 0xC0:
+        if end is None: end = off + 2
+        ptr = (c & 0x3F) << 8 | buf[off + 1]
+        suffix = names.get(ptr)
+        if suffix is not None:
+          break
+        # each pointer must go further back, so a malicious message can't loop
+        if ptr >= limit:
+          raise ValueError('bad compression pointer at %d' % off)
+        off = limit = ptr
+        continue
+      starts.append(off)
+      labels.append(str(buf[off + 1:off + 1 + c], 'ascii'))
+      off += 1 + c
+    if end is None: end = off + 1
+    for i in range(len(labels) - 1, -1, -1):
+      suffix = labels[i] + '.' + suffix if suffix else labels[i]
+      names[starts[i]] = suffix
+    return suffix, end
 
   def packquiz(self, name, qtype, cls):
     return self.packname(name) + struct.pack('>HH', qtype, cls)
 
-  def unpackquiz(self, s):
-    name, r = self.unpackname(s), struct.unpack('>HH', s.read(4))
-    return name, r[0], r[1]
+  def unpackquiz(self, off):
+    name, off = self.unpackname(off)
+    qtype, cls = _QUIZ.unpack_from(self._data, off)
+    return (name, qtype, cls), off + 4
 
-  def read_string(self, s, length):
-    consumed = 0
+  def read_string(self, off, length):
+    buf = self._data
+    end = off + length
     r = []
-    while consumed < length:
-      new_len = s.read(1)[0]
-      r.append(s.read(new_len))
-      consumed += new_len + 1
+    while off < end:
+      n = buf[off]
+      r.append(bytes(buf[off + 1:off + 1 + n]))
+      off += n + 1
     return b''.join(r)
 
   def showquiz(self, q):
@@ -149,34 +179,50 @@ class Record(object):
   #   return self.packname(name) + \
   #     struct.pack('>HHIH', type, cls, ttl, len(res)) + res
 
-  def unpackRR(self, s):
-    n = self.unpackname(s)
-    r = struct.unpack('>HHIH', s.read(10))
-    if r[0] == TYPE.A:
-      return n, r[0], r[1], r[2], socket.inet_ntoa(s.read(r[3]))
-    elif r[0] == TYPE.CNAME:
-      return n, r[0], r[1], r[2], self.unpackname(s)
-    elif r[0] == TYPE.MX:
-      return n, r[0], r[1], r[2], \
-        struct.unpack('>H', s.read(2))[0], self.unpackname(s)
-    elif r[0] == TYPE.PTR:
-      return n, r[0], r[1], r[2], self.unpackname(s)
-    elif r[0] == TYPE.SOA:
-      rr = [n, r[0], r[1], r[2], self.unpackname(s), self.unpackname(s)]
-      rr.extend(struct.unpack('>IIIII', s.read(20)))
-      return tuple(rr)
-    elif r[0] == TYPE.TXT:
-      return n, r[0], r[1], r[2], self.read_string(s, r[3])
-    else: raise Exception("don't know howto handle type, %s." % str(r))
+  def unpackRR(self, off):
+    n, off = self.unpackname(off)
+    buf = self._data
+    type, cls, ttl, length = _RR_HEADER.unpack_from(buf, off)
+    off += 10
+    end = off + length
+    if type in _ADDR_LENGTH:
+      if length != _ADDR_LENGTH[type]:
+        raise ValueError('bad %s rdata length %d at %d' % (
+          TYPE.lookup(type), length, off))
+      if end > len(buf):
+        raise ValueError('truncated resource record at %d' % off)
+    if type == TYPE.A:
+      rr = n, type, cls, ttl, '%d.%d.%d.%d' % tuple(buf[off:end])
+    elif type in (TYPE.CNAME, TYPE.PTR, TYPE.NS):
+      rr = n, type, cls, ttl, self.unpackname(off)[0]
+    elif type == TYPE.MX:
+      rr = n, type, cls, ttl, \
+        struct.unpack_from('>H', buf, off)[0], self.unpackname(off + 2)[0]
+    elif type == TYPE.AAAA:
+      rr = n, type, cls, ttl, socket.inet_ntop(socket.AF_INET6, buf[off:end])
+    elif type == TYPE.SRV:
+      rr = (n, type, cls, ttl) + struct.unpack_from('>HHH', buf, off) + \
+        (self.unpackname(off + 6)[0],)
+    elif type == TYPE.SOA:
+      mname, o = self.unpackname(off)
+      rname, o = self.unpackname(o)
+      rr = (n, type, cls, ttl, mname, rname) + struct.unpack_from('>IIIII', buf, o)
+    elif type == TYPE.TXT:
+      rr = n, type, cls, ttl, self.read_string(off, length)
+    else:
+      # keep the raw rdata of types we don't know (OPT, DNSSEC, etc.)
+      rr = n, type, cls, ttl, bytes(buf[off:end])
+    return rr, end
 
   def showRR(self, r):
-    if r[1] in (TYPE.A, TYPE.CNAME, TYPE.PTR, TYPE.SOA):
-      return '\t%s\t%d\t%s\t%s\t%s' % (
-        r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1]), r[4])
-    elif r[1] == TYPE.MX:
-      return '\t%s\t%d\t%s\t%s\t%s' % (
-        r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1]), r[5])
-    else: raise Exception("don't know howto handle type, %s." % str(r))
+    if r[1] == TYPE.MX:
+      data = '%d %s' % (r[4], r[5])
+    elif r[1] in (TYPE.SRV, TYPE.SOA):
+      data = ' '.join(str(x) for x in r[4:])
+    else:
+      data = r[4]
+    return '\t%s\t%d\t%s\t%s\t%s' % (
+      r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1], r[1]), data)
 
   def pack(self):
     self.buf = struct.pack(
@@ -191,21 +237,64 @@ class Record(object):
 
   @classmethod
   def unpack(cls, dt):
-    s = io.BytesIO(dt)
-    id, flag, lquiz, lans, lauth, lex = struct.unpack('>HHHHHH', s.read(12))
+    '''decode a DNS message from any bytes-like object
+
+    bytearray and memoryview input is walked in place, not copied.
+    '''
+    id, flag, lquiz, lans, lauth, lex = _HEADER.unpack_from(dt)
     rec = cls(id, *unpackflag(flag))
     rec.buf = dt
-    rec.quiz = [rec.unpackquiz(s) for i in range(lquiz)]
-    rec.ans = [rec.unpackRR(s) for i in range(lans)]
-    rec.auth = [rec.unpackRR(s) for i in range(lauth)]
-    rec.ex = [rec.unpackRR(s) for i in range(lex)]
+    rec._data = dt if isinstance(dt, bytes) else memoryview(dt)
+    rec._names = {}
+    off = 12
+    for i in range(lquiz):
+      q, off = rec.unpackquiz(off)
+      rec.quiz.append(q)
+    for l, section in ((lans, rec.ans), (lauth, rec.auth), (lex, rec.ex)):
+      for i in range(l):
+        r, off = rec.unpackRR(off)
+        section.append(r)
+    del rec._data, rec._names
     return rec
 
 def mkquery(*ntlist):
-  rec = Record(random.randint(0, 65536), 0, OPCODE.QUERY, 0, 0, 1, 0, 0)
+  rec = Record(random.randint(0, 65535), 0, OPCODE.QUERY, 0, 0, 1, 0, 0)
   for name, type in ntlist: rec.quiz.append((name, type, CLASS.IN))
   return rec
 
+def skipname(buf, off):
+  '''return the offset after the (possibly compressed) name at `off`'''
+  while True:
+    c = buf[off]
+    if c == 0:
+      return off + 1
+    if c & 0xC0 == 0xC0:
+      return off + 2
+    off += 1 + c
+
+def rr_offsets(buf):
+  '''locate the resource records of a message without decoding them
+
+  Returns the offset where the question section ends and a list of
+  (start, type, ttl_offset, end) for every RR, in message order.
+  '''
+  lquiz, lans, lauth, lex = struct.unpack_from('>HHHH', buf, 4)
+  off = 12
+  for i in range(lquiz):
+    off = skipname(buf, off) + 4
+  qend = off
+  r = []
+  for i in range(lans + lauth + lex):
+    start = off
+    off = skipname(buf, off)
+    type, length = struct.unpack_from('>H6xH', buf, off)
+    end = off + 10 + length
+    if end > len(buf):
+      raise ValueError('truncated resource record at %d' % start)
+    r.append((start, type, off + 4, end))
+    off = end
+  return qend, r
+
 def query_by_udp(q, server, port=53, sock=None):
   if sock is None: sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
   sock.sendto(q, (server, port))
@@ -216,7 +305,7 @@ def query_by_tcp(q, server, port=53, stream=None):
   if stream is None:
     sock = socket.socket()
     sock.connect((server, port))
-    stream = sock.makefile()
+    stream = sock.makefile('rwb')
   try:
     stream.write(struct.pack('>H', len(q)) + q)
     stream.flush()
@@ -237,4 +326,347 @@ def query(name, type=TYPE.A, server='127.0.0.1', port=53, protocol='udp'):
 
 def nslookup(name):
   r = query(name)
-  return [rdata for name, type, cls, ttl, rdata in r.ans if type == TYPE.A]
+  return [rr[4] for rr in r.ans if rr[1] == TYPE.A]
+
+# responses to www.example.com/A (CNAME, A, MX, NS, glue and OPT) and to an
+# SRV query (SRV, AAAA, TXT and SOA), used by benchmark_unpack
+_SAMPLE_RESPONSES = [bytes.fromhex(x) for x in (
+  '12348180000100040002000203777777076578616d706c6503636f6d0000010001c00c00'
+  '0500010000012c000603776562c010c02d000100010000003c000401020304c02d000100'
+  '010000003c000401020305c02d000f00010000003c0007000a026d78c010c01000020001'
+  '00000e100006036e7331c010c0100002000100000e100006036e7332c010c07200010001'
+  '00000e100004090909090000290001000000000000',
+  '123481800001000300010000025f78045f7463700165036f72670000210001c00c002100'
+  '010000000a000f00010005146601680165036f726700c00c001c00010000000a00102001'
+  '0db8000000000000000000000001c00c001000010000000a000703616263026465c01400'
+  '0600010000000a0025026e730165036f72670004726f6f74c014000000010000000200'
+  '0000030000000400000005',
+)]
+
+def benchmark_unpack(*files, number=20000):
+  '''print how many messages per second Record.unpack decodes
+
+  Each file holds one raw DNS message, e.g. a UDP payload saved from a
+  capture; without files some built-in responses are used.
+  '''
+  import timeit
+  if files:
+    msgs = []
+    for f in files:
+      with open(f, 'rb') as fp:
+        msgs.append(fp.read())
+  else:
+    msgs = _SAMPLE_RESPONSES
+  total = 0
+  for i, m in enumerate(msgs):
+    t = timeit.timeit(lambda: Record.unpack(m), number=number)
+    total += t
+    print('%s: %d bytes, %.0f msg/s' % (
+      files[i] if files else 'sample %d' % i, len(m), number / t))
+  print('overall: %.0f msg/s' % (number * len(msgs) / total))
+
+class _TCPConnection:
+  '''one pipelined DNS-over-TCP connection; replies are matched by id'''
+  def __init__(self, reader, writer):
+    self.reader, self.writer = reader, writer
+    self.pending = {}
+    self.closed = False
+    self._task = asyncio.ensure_future(self._read_loop())
+
+  def send(self, rec):
+    while True:
+      rec.id = random.randint(0, 65535)
+      if rec.id not in self.pending:
+        break
+    q = rec.pack()
+    fut = asyncio.get_event_loop().create_future()
+    self.pending[rec.id] = fut, [(n.lower(), t, c) for n, t, c in rec.quiz]
+    self.writer.write(struct.pack('>H', len(q)) + q)
+    return fut
+
+  async def _read_loop(self):
+    reader, pending = self.reader, self.pending
+    exc = ConnectionAbortedError('DNS connection closed')
+    try:
+      while True:
+        n = struct.unpack('>H', await reader.readexactly(2))[0]
+        data = await reader.readexactly(n)
+        if n < 12:
+          continue
+        p = pending.get(struct.unpack_from('>H', data)[0])
+        if p is None or p[0].done():
+          continue
+        fut, quiz = p
+        try:
+          rec = Record.unpack(data)
+        except Exception as e:
+          fut.set_exception(e)
+          continue
+        if [(n.lower(), t, c) for n, t, c in rec.quiz] == quiz:
+          fut.set_result(rec)
+    except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+      exc = ConnectionResetError('DNS connection closed: %r' % e)
+    except asyncio.CancelledError:
+      pass
+    except Exception as e:
+      logger.exception('DNS connection failed')
+      exc = ConnectionResetError('DNS connection failed: %r' % e)
+    finally:
+      # whatever happened, don't let TCPClient hand this connection out again
+      self.closed = True
+      self.writer.close()
+      for fut, _ in pending.values():
+        if not fut.done():
+          fut.set_exception(exc)
+
+  def close(self):
+    if not self.closed:
+      self._task.cancel()
+
+class TCPClient:
+  '''pooled, pipelined DNS over TCP to one upstream server
+
+  Up to `connections` connections are kept open and reused, each carrying
+  up to `pipeline` outstanding queries; replies may arrive in any order.
+  A query whose connection is closed under it (servers drop idle or busy
+  connections) is retried once on a fresh one.
+  '''
+  def __init__(self, server='127.0.0.1', port=53, *, connections=2,
+               pipeline=64, timeout=5):
+    self.server, self.port = server, port
+    self.connections, self.pipeline = connections, pipeline
+    self.timeout = timeout
+    self._conns = []
+    self._lock = None
+    self._slots = None
+
+  async def _get_conn(self):
+    if self._lock is None:
+      self._lock = asyncio.Lock()
+    async with self._lock:
+      self._conns = conns = [c for c in self._conns if not c.closed]
+      if conns:
+        conn = min(conns, key=lambda c: len(c.pending))
+        if not conn.pending or len(conns) >= self.connections:
+          return conn
+      reader, writer = await asyncio.open_connection(self.server, self.port)
+      conn = _TCPConnection(reader, writer)
+      conns.append(conn)
+      return conn
+
+  async def send(self, rec):
+    '''send the query `rec` (its id is replaced) and return the reply'''
+    if self._slots is None:
+      self._slots = asyncio.Semaphore(self.connections * self.pipeline)
+    async with self._slots:
+      for retry in (True, False):
+        conn = await self._get_conn()
+        fut = conn.send(rec)
+        id = rec.id
+        try:
+          return await asyncio.wait_for(fut, self.timeout)
+        except ConnectionResetError:
+          if not retry:
+            raise
+        finally:
+          conn.pending.pop(id, None)
+
+  async def query(self, name, type=TYPE.A):
+    return await self.send(mkquery((name, type)))
+
+  async def query_many(self, names, type=TYPE.A):
+    '''query all `names`, pipelined over the pooled connections
+
+    Returns a list in the order of `names`, holding a `Record` or the
+    exception raised for that name.
+    '''
+    return await asyncio.gather(
+      *[self.query(name, type) for name in names], return_exceptions=True)
+
+  def close(self):
+    for c in self._conns:
+      c.close()
+    self._conns = []
+
+def query_many(names, type=TYPE.A, server='127.0.0.1', port=53, **kwargs):
+  '''blocking wrapper around TCPClient.query_many'''
+  loop = asyncio.new_event_loop()
+  client = TCPClient(server, port, **kwargs)
+  try:
+    return loop.run_until_complete(client.query_many(names, type))
+  finally:
+    client.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+class _ResolverProtocol(asyncio.DatagramProtocol):
+  def __init__(self, resolver):
+    self.resolver = resolver
+
+  def datagram_received(self, data, addr):
+    self.resolver._datagram_received(data)
+
+  def error_received(self, exc):
+    logger.debug('resolver socket error: %s', exc)
+
+class Resolver:
+  '''asyncio stub resolver with a TTL cache
+
+  All queries share one UDP socket and are matched by transaction id. A
+  query is resent every `timeout` seconds up to `retries` times, and is
+  retried over a pooled TCP connection (see `TCPClient`) when the reply has
+  the TC bit set.
+
+  Replies are cached for the smallest TTL among their answers; NXDOMAIN and
+  empty answers are cached for the SOA minimum (RFC 2308), at most
+  `negative_ttl` seconds, and not at all without an SOA. The cache holds at
+  most `cache_size` entries and drops the least recently used ones. Cached
+  `Record` objects are shared and should not be modified.
+
+  At most `max_inflight` queries are outstanding at a time so that a burst
+  doesn't overflow socket buffers.
+  '''
+  def __init__(self, server='127.0.0.1', port=53, *, timeout=2, retries=3,
+               cache_size=10000, negative_ttl=300, max_inflight=256):
+    self.server, self.port = server, port
+    self.timeout, self.retries = timeout, retries
+    self.cache_size, self.negative_ttl = cache_size, negative_ttl
+    self._cache = OrderedDict()
+    self._pending = {}
+    self._transport = None
+    self._connecting = None
+    self.max_inflight = max_inflight
+    self._inflight = None
+    self._tcp = None
+    self.hits = self.misses = 0
+
+  async def _get_transport(self):
+    if self._transport is None:
+      if self._connecting is None:
+        loop = asyncio.get_event_loop()
+        self._connecting = asyncio.ensure_future(loop.create_datagram_endpoint(
+          lambda: _ResolverProtocol(self), remote_addr=(self.server, self.port)))
+      try:
+        self._transport = (await self._connecting)[0]
+      finally:
+        self._connecting = None
+    return self._transport
+
+  def _datagram_received(self, data):
+    if len(data) < 12:
+      return
+    id = struct.unpack_from('>H', data)[0]
+    p = self._pending.get(id)
+    if p is None or p[0].done():
+      return
+    fut, quiz = p
+    try:
+      rec = Record.unpack(data)
+    except Exception as e:
+      fut.set_exception(e)
+      return
+    if [(n.lower(), t, c) for n, t, c in rec.quiz] != quiz:
+      # stale or spoofed reply: keep waiting for the right one
+      return
+    fut.set_result(rec)
+
+  def _new_id(self):
+    while True:
+      id = random.randint(0, 65535)
+      if id not in self._pending:
+        return id
+
+  async def query(self, name, type=TYPE.A):
+    name = name.rstrip('.')
+    key = name.lower(), type
+    r = self._cache.get(key)
+    if r is not None:
+      if r[0] > time.monotonic():
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return r[1]
+      del self._cache[key]
+    self.misses += 1
+
+    if self._inflight is None:
+      self._inflight = asyncio.Semaphore(self.max_inflight)
+    async with self._inflight:
+      rec = await self._query_udp(mkquery((name, type)))
+    self._store(key, rec)
+    return rec
+
+  async def _query_udp(self, rec):
+    transport = await self._get_transport()
+    rec.id = self._new_id()
+    q = rec.pack()
+    loop = asyncio.get_event_loop()
+    fut = loop.create_future()
+    tries = 0
+    timer = None
+
+    def send():
+      nonlocal tries, timer
+      if fut.done():
+        return
+      if tries == self.retries:
+        fut.set_exception(asyncio.TimeoutError())
+        return
+      tries += 1
+      transport.sendto(q)
+      timer = loop.call_later(self.timeout, send)
+
+    self._pending[rec.id] = fut, [(n.lower(), t, c) for n, t, c in rec.quiz]
+    try:
+      send()
+      reply = await fut
+    finally:
+      if timer is not None:
+        timer.cancel()
+      del self._pending[rec.id]
+
+    if reply.truncated:
+      if self._tcp is None:
+        self._tcp = TCPClient(self.server, self.port, connections=1,
+                              timeout=self.timeout)
+      reply = await self._tcp.send(rec)
+    return reply
+
+  def _store(self, key, rec):
+    if rec.rcode == 3 or (rec.rcode == 0 and not rec.ans):
+      soa = [min(r[3], r[-1]) for r in rec.auth if r[1] == TYPE.SOA]
+      # without an SOA there's nothing to say how long (RFC 2308 section 5)
+      ttl = min(soa + [self.negative_ttl]) if soa else 0
+    elif rec.rcode == 0:
+      ttl = min(r[3] for r in rec.ans)
+    else:
+      return
+    if ttl <= 0:
+      return
+    self._cache[key] = time.monotonic() + ttl, rec
+    self._cache.move_to_end(key)
+    while len(self._cache) > self.cache_size:
+      self._cache.popitem(last=False)
+
+  async def nslookup(self, name):
+    r = await self.query(name)
+    return [rr[4] for rr in r.ans if rr[1] == TYPE.A]
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      'size': len(self._cache),
+      'pending': len(self._pending),
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / total if total else 0.0,
+    }
+
+  def close(self):
+    if self._transport is not None:
+      self._transport.close()
+      self._transport = None
+    if self._tcp is not None:
+      self._tcp.close()
+    for fut, _ in self._pending.values():
+      if not fut.done():
+        fut.cancel()
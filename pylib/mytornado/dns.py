@@ -1,11 +1,22 @@
 # vim:fileencoding=utf-8
 
 import socket
+import struct
+import time
+import random
+import logging
+from collections import OrderedDict
 from functools import partial
 
 import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.tcpserver
+from tornado import gen
 
-from mydns import TYPE, Record, mkquery
+from mydns import TYPE, Record, mkquery, skipname, rr_offsets
+
+logger = logging.getLogger(__name__)
 
 def query_via_udp(name, callback, type=TYPE.A, server='127.0.0.1', port=53, *, sock=None, ioloop=None):
   q = mkquery((name, type)).pack()
@@ -24,6 +35,522 @@ def _recv_dns_msg(callback, ioloop, sock, fd, events):
   ioloop.remove_handler(fd)
   callback(ret)
 
+# an EDNS(0) OPT RR advertising a 4096-byte UDP payload
+_OPT_RR = b'\x00' + struct.pack('>HHIH', TYPE.OPT, 4096, 0, 0)
+_random = random.SystemRandom()
+
+class _CacheEntry:
+  __slots__ = ('data', 'ttl_offsets', 'stored', 'ttl', 'hits')
+
+  def __init__(self, data, ttl_offsets, stored, ttl):
+    self.data, self.ttl_offsets = data, ttl_offsets
+    self.stored, self.ttl = stored, ttl
+    self.hits = 0
+
+class _ClientQuery:
+  __slots__ = ('id', 'rd', 'question', 'edns', 'max_size', 'start', 'respond')
+
+  def __init__(self, id, rd, question, edns, max_size, start, respond):
+    self.id, self.rd, self.question, self.edns = id, rd, question, edns
+    self.max_size, self.start, self.respond = max_size, start, respond
+
+class _UpstreamQuery:
+  __slots__ = ('id', 'key', 'question', 'packet', 'waiters', 'start',
+               'tries', 'timeout')
+
+  def __init__(self, id, key, question):
+    self.id, self.key, self.question = id, key, question
+    self.packet = struct.pack('>HHHHHH', id, 0x0100, 1, 0, 0, 1) + \
+        question + _OPT_RR
+    self.waiters = []
+    self.start = time.monotonic()
+    self.tries = 0
+    self.timeout = None
+
+def _close_stream(fut):
+  '''close the stream of a connect that finished after we gave up on it'''
+  if fut.exception() is None:
+    fut.result().close()
+
+class _ForwarderTCPServer(tornado.tcpserver.TCPServer):
+  def __init__(self, forwarder):
+    super().__init__()
+    self.forwarder = forwarder
+
+  @gen.coroutine
+  def handle_stream(self, stream, address):
+    try:
+      while True:
+        n = struct.unpack('>H', (yield stream.read_bytes(2)))[0]
+        data = yield stream.read_bytes(n)
+        self.forwarder.handle_query(data, partial(self._reply, stream), 65535)
+    except tornado.iostream.StreamClosedError:
+      pass
+
+  def _reply(self, stream, data):
+    if not stream.closed():
+      stream.write(struct.pack('>H', len(data)) + data)
+
+class Forwarder:
+  '''caching DNS forwarder
+
+  Queries received on the UDP and TCP sockets opened by `listen()` are
+  answered from an in-memory cache or forwarded over UDP to `upstreams`, a
+  list of (IPv4 address, port), retrying over TCP when a reply is
+  truncated. Concurrent queries for the same question share one upstream
+  query. An entry asked for at least `prefetch_hits` times is refreshed in
+  the background once less than `prefetch` of its TTL is left.
+
+  Cached replies keep their original TTLs and are aged on the way out.
+  Negative answers are cached for the SOA minimum, at most `negative_ttl`
+  seconds; those without an SOA, SERVFAIL and the like are not cached.
+
+  At most `max_inflight` questions are forwarded at a time, so that a slow
+  upstream can't use up the query ids; misses beyond that get SERVFAIL
+  right away. See `stats()` for the counters.
+  '''
+  timeout = 2
+  retries = 2
+
+  def __init__(self, upstreams, *, cache_size=10000, max_ttl=86400,
+               negative_ttl=300, prefetch=0.1, prefetch_hits=2,
+               max_inflight=1024, io_loop=None):
+    if not 0 < max_inflight <= 32768:
+      raise ValueError('max_inflight must be between 1 and 32768')
+    self.upstreams = [(socket.gethostbyname(host), port)
+                      for host, port in upstreams]
+    self.cache_size, self.max_ttl = cache_size, max_ttl
+    self.negative_ttl = negative_ttl
+    self.prefetch, self.prefetch_hits = prefetch, prefetch_hits
+    self.max_inflight = max_inflight
+    self.io_loop = io_loop or tornado.ioloop.IOLoop.current()
+
+    self._cache = OrderedDict()
+    self._inflight = {}
+    self._pending = {}
+    self._socks = []
+    self._tcp_server = None
+
+    self.counters = dict.fromkeys((
+      'queries', 'hits', 'misses', 'coalesced', 'prefetches',
+      'upstream_queries', 'upstream_timeouts', 'servfails', 'overloaded'), 0)
+    # count, sum and max in seconds
+    self._latency = {'answer': [0, 0.0, 0.0], 'upstream': [0, 0.0, 0.0]}
+
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._sock.setblocking(False)
+    self.io_loop.add_handler(self._sock.fileno(), self._on_upstream_reply,
+                             self.io_loop.READ)
+
+  def listen(self, port=53, address=''):
+    '''listen on UDP and TCP; with port 0, return the port chosen'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setblocking(False)
+    sock.bind((address, port))
+    port = sock.getsockname()[1]
+    self.io_loop.add_handler(sock.fileno(), partial(self._on_udp_query, sock),
+                             self.io_loop.READ)
+    self._socks.append(sock)
+
+    if self._tcp_server is None:
+      self._tcp_server = _ForwarderTCPServer(self)
+    self._tcp_server.listen(port, address)
+    return port
+
+  def _on_udp_query(self, sock, fd, events):
+    while True:
+      try:
+        data, addr = sock.recvfrom(65535)
+      except (BlockingIOError, InterruptedError):
+        return
+      self.handle_query(data, partial(self._send_udp, sock, addr), 512)
+
+  def _send_udp(self, sock, addr, data):
+    try:
+      sock.sendto(data, addr)
+    except OSError as e:
+      logger.debug('failed to answer %s: %s', addr, e)
+
+  def handle_query(self, data, respond, max_size):
+    '''answer the query message `data` by calling `respond(reply)`
+
+    `max_size` is the largest reply the transport allows without EDNS.
+    '''
+    start = time.monotonic()
+    try:
+      id, flags, lquiz = struct.unpack_from('>HHH', data)
+      if flags & 0x8000 or lquiz != 1:
+        raise ValueError('not a single question query')
+      qend, rrs = rr_offsets(data)
+    except (ValueError, IndexError, struct.error) as e:
+      logger.debug('dropping malformed query: %s', e)
+      return
+    self.counters['queries'] += 1
+
+    edns = False
+    for rr_start, type, ttl_off, rr_end in rrs:
+      if type == TYPE.OPT:
+        edns = True
+        size = struct.unpack_from('>H', data, ttl_off - 2)[0]
+        max_size = max(max_size, min(size, 4096))
+    question = bytes(data[12:qend])
+    c = _ClientQuery(id, flags & 0x0100, question, edns, max_size, start, respond)
+    if flags & 0x7800: # not a standard query
+      self._respond(c, self._header_only(c, 0x8004))
+      return
+
+    # names are case-insensitive, the type and class that follow are not
+    key = question[:-4].lower() + question[-4:]
+    now = start
+    entry = self._cache.get(key)
+    if entry is not None:
+      age = now - entry.stored
+      if age < entry.ttl:
+        self.counters['hits'] += 1
+        entry.hits += 1
+        self._cache.move_to_end(key)
+        self._respond(c, self._answer(entry, c, int(age)))
+        if (entry.hits >= self.prefetch_hits and
+            entry.ttl - age < entry.ttl * self.prefetch and
+            key not in self._inflight and
+            len(self._inflight) < self.max_inflight):
+          self.counters['prefetches'] += 1
+          self._forward(key, question)
+        return
+      del self._cache[key]
+
+    self.counters['misses'] += 1
+    q = self._inflight.get(key)
+    if q is not None:
+      self.counters['coalesced'] += 1
+      q.waiters.append(c)
+    elif len(self._inflight) >= self.max_inflight:
+      self.counters['overloaded'] += 1
+      self._respond(c, self._header_only(c, 0x8082))
+    else:
+      self._forward(key, question).waiters.append(c)
+
+  def _respond(self, c, data):
+    c.respond(data)
+    self._add_latency('answer', time.monotonic() - c.start)
+
+  def _add_latency(self, name, t):
+    l = self._latency[name]
+    l[0] += 1
+    l[1] += t
+    if t > l[2]:
+      l[2] = t
+
+  def _forward(self, key, question):
+    while True:
+      id = _random.randint(0, 65535)
+      if id not in self._pending:
+        break
+    q = _UpstreamQuery(id, key, question)
+    self._inflight[key] = self._pending[id] = q
+    self._send_upstream(q)
+    return q
+
+  def _send_upstream(self, q):
+    if q.tries > self.retries:
+      self._fail(q)
+      return
+    upstream = self.upstreams[q.tries % len(self.upstreams)]
+    q.tries += 1
+    self.counters['upstream_queries'] += 1
+    try:
+      self._sock.sendto(q.packet, upstream)
+    except OSError as e:
+      logger.warning('failed to send query to %s: %s', upstream, e)
+    q.timeout = self.io_loop.call_later(self.timeout, self._upstream_timeout, q)
+
+  def _upstream_timeout(self, q):
+    self.counters['upstream_timeouts'] += 1
+    self._send_upstream(q)
+
+  def _stop_udp(self, q):
+    self._pending.pop(q.id, None)
+    if q.timeout is not None:
+      self.io_loop.remove_timeout(q.timeout)
+      q.timeout = None
+
+  def _fail(self, q):
+    self._stop_udp(q)
+    del self._inflight[q.key]
+    self.counters['servfails'] += 1
+    for c in q.waiters:
+      self._respond(c, self._header_only(c, 0x8082))
+
+  def _on_upstream_reply(self, fd, events):
+    while True:
+      try:
+        data, addr = self._sock.recvfrom(65535)
+      except (BlockingIOError, InterruptedError):
+        return
+      except OSError as e:
+        logger.debug('upstream socket error: %s', e)
+        return
+      if addr not in self.upstreams or len(data) < 12:
+        continue
+      q = self._pending.get(struct.unpack_from('>H', data)[0])
+      if q is None or \
+         data[12:12 + len(q.question)].lower() != q.question.lower():
+        continue
+      self._stop_udp(q)
+      if data[2] & 0x02: # truncated
+        self._forward_tcp(q, addr)
+      else:
+        self._got_reply(q, data)
+
+  @gen.coroutine
+  def _forward_tcp(self, q, upstream):
+    deadline = self.io_loop.time() + self.timeout
+    connect = tornado.tcpclient.TCPClient().connect(*upstream)
+    stream = None
+    try:
+      stream = yield gen.with_timeout(deadline, connect)
+      stream.write(struct.pack('>H', len(q.packet)) + q.packet)
+      n = yield gen.with_timeout(deadline, stream.read_bytes(2))
+      data = yield gen.with_timeout(
+        deadline, stream.read_bytes(struct.unpack('>H', n)[0]))
+      if len(data) < 12 or struct.unpack_from('>H', data)[0] != q.id:
+        raise ValueError('bad reply of %d bytes' % len(data))
+    except Exception as e:
+      # whatever happens, q must not stay in _inflight
+      logger.warning('TCP query to %s failed: %r', upstream, e)
+      self._fail(q)
+      return
+    finally:
+      if stream is not None:
+        stream.close()
+      elif not connect.done():
+        connect.add_done_callback(_close_stream)
+    self._got_reply(q, data)
+
+  def _got_reply(self, q, data):
+    del self._inflight[q.key]
+    now = time.monotonic()
+    self._add_latency('upstream', now - q.start)
+    try:
+      rec = Record.unpack(data)
+      qend, rrs = rr_offsets(data)
+    except Exception as e:
+      logger.warning('bad reply for %r: %r', q.question, e)
+      self.counters['servfails'] += 1
+      for c in q.waiters:
+        self._respond(c, self._header_only(c, 0x8082))
+      return
+
+    # drop the upstream's OPT RR, EDNS clients get our own
+    out = bytearray(data[:qend])
+    ttl_offsets = []
+    dropped = 0
+    for rr_start, type, ttl_off, rr_end in rrs:
+      if type == TYPE.OPT:
+        dropped += 1
+        continue
+      ttl_offsets.append(len(out) + ttl_off - rr_start)
+      out += data[rr_start:rr_end]
+    if dropped:
+      struct.pack_into('>H', out, 10, len(rec.ex) - dropped)
+    entry = _CacheEntry(bytes(out), ttl_offsets, now, self._reply_ttl(rec))
+    if entry.ttl > 0:
+      self._cache[q.key] = entry
+      self._cache.move_to_end(q.key)
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+    for c in q.waiters:
+      self._respond(c, self._answer(entry, c, 0))
+
+  def _reply_ttl(self, rec):
+    if rec.rcode == 3 or (rec.rcode == 0 and not rec.ans):
+      soa = [min(r[3], r[-1]) for r in rec.auth if r[1] == TYPE.SOA]
+      # without an SOA there's nothing to say how long (RFC 2308 section 5)
+      return min(soa + [self.negative_ttl]) if soa else 0
+    elif rec.rcode == 0:
+      return min([self.max_ttl] + [r[3] for r in rec.ans])
+    else:
+      return 0
+
+  def _answer(self, entry, c, age):
+    buf = bytearray(entry.data)
+    flags = buf[2] << 8 | buf[3]
+    struct.pack_into('>HH', buf, 0, c.id, flags & ~0x0100 | c.rd)
+    # keep the client's capitalization of the name
+    buf[12:12 + len(c.question)] = c.question
+    if age:
+      for off in entry.ttl_offsets:
+        ttl = struct.unpack_from('>I', buf, off)[0]
+        struct.pack_into('>I', buf, off, max(ttl - age, 0))
+    if c.edns:
+      struct.pack_into('>H', buf, 10, (buf[10] << 8 | buf[11]) + 1)
+      buf += _OPT_RR
+    if len(buf) > c.max_size:
+      return self._header_only(c, flags | 0x0200)
+    return bytes(buf)
+
+  def _header_only(self, c, flags):
+    '''a reply with no records and the given flags (QR, TC, rcode...)'''
+    flags = flags & ~0x0100 | c.rd | 0x0080
+    return struct.pack('>HHHHHH', c.id, flags, 1, 0, 0, int(c.edns)) + \
+        c.question + (_OPT_RR if c.edns else b'')
+
+  def stats(self):
+    r = dict(self.counters)
+    lookups = r['hits'] + r['misses']
+    r['hit_rate'] = r['hits'] / lookups if lookups else 0.0
+    r['cache_size'] = len(self._cache)
+    r['inflight'] = len(self._inflight)
+    for name, (n, total, max_t) in self._latency.items():
+      r[name + '_latency_avg_ms'] = total / n * 1000 if n else 0.0
+      r[name + '_latency_max_ms'] = max_t * 1000
+    return r
+
+  def close(self):
+    for q in list(self._pending.values()):
+      self._stop_udp(q)
+    self._inflight.clear()
+    for sock in self._socks + [self._sock]:
+      self.io_loop.remove_handler(sock.fileno())
+      sock.close()
+    self._socks = []
+    if self._tcp_server is not None:
+      self._tcp_server.stop()
+
+class _FakeUpstream(tornado.tcpserver.TCPServer):
+  '''a DNS server on 127.0.0.1 for selftest()
+
+  Every name gets one A record 10.0.0.1 with a TTL of 60, except that
+  ``big.*`` is truncated over UDP and gets 100 of them over TCP, and
+  ``dead.*`` gets no answer at all.
+  '''
+  def __init__(self, io_loop):
+    super().__init__()
+    self.udp_queries = self.tcp_queries = 0
+    self.io_loop = io_loop
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.setblocking(False)
+    self.port = self.sock.getsockname()[1]
+    io_loop.add_handler(self.sock.fileno(), self._on_udp, io_loop.READ)
+    self.listen(self.port, '127.0.0.1')
+
+  def reply(self, q, tcp):
+    qend = skipname(q, 12) + 4
+    question = q[12:qend]
+    n = 1
+    flags = 0x8180
+    if question.startswith(b'\x03big'):
+      if tcp:
+        n = 100
+      else:
+        flags |= 0x0200
+        n = 0
+    rr = b'\xc0\x0c' + struct.pack('>HHIH', TYPE.A, 1, 60, 4) + bytes((10, 0, 0, 1))
+    return q[:2] + struct.pack('>HHHHH', flags, 1, n, 0, 0) + question + rr * n
+
+  def _on_udp(self, fd, events):
+    q, addr = self.sock.recvfrom(65535)
+    self.udp_queries += 1
+    if q[12:17] != b'\x04dead':
+      self.sock.sendto(self.reply(q, False), addr)
+
+  @gen.coroutine
+  def handle_stream(self, stream, address):
+    try:
+      while True:
+        n = struct.unpack('>H', (yield stream.read_bytes(2)))[0]
+        q = yield stream.read_bytes(n)
+        self.tcp_queries += 1
+        r = self.reply(q, True)
+        stream.write(struct.pack('>H', len(r)) + r)
+    except tornado.iostream.StreamClosedError:
+      pass
+
+  def close(self):
+    self.io_loop.remove_handler(self.sock.fileno())
+    self.sock.close()
+    self.stop()
+
+def selftest():
+  '''check Forwarder against a fake upstream; raise AssertionError on failure'''
+  from tornado.concurrent import Future
+  ioloop = tornado.ioloop.IOLoop.current()
+
+  @gen.coroutine
+  def run():
+    upstream = _FakeUpstream(ioloop)
+    f = Forwarder([('127.0.0.1', upstream.port)], io_loop=ioloop)
+    f.timeout = 0.2
+    f.retries = 1
+
+    def ask(name, max_size=512):
+      fut = Future()
+      f.handle_query(mkquery((name, TYPE.A)).pack(), fut.set_result, max_size)
+      return fut
+
+    # concurrent misses share one upstream query
+    replies = yield [ask('a.test') for i in range(10)]
+    replies = [Record.unpack(r) for r in replies]
+    assert all(r.ans[0][4] == '10.0.0.1' for r in replies), replies
+    assert upstream.udp_queries == 1, upstream.udp_queries
+    assert f.stats()['coalesced'] == 9
+    print('coalescing: ok')
+
+    # hits are aged
+    for entry in f._cache.values():
+      entry.stored -= 20
+    r = Record.unpack((yield ask('a.test')))
+    assert r.ans[0][3] == 40 and upstream.udp_queries == 1, r.ans
+    assert f.stats()['hits'] == 1
+    print('TTL ageing: ok')
+
+    # truncated over UDP, retried over TCP
+    r = Record.unpack((yield ask('big.test', 65535)))
+    assert len(r.ans) == 100 and upstream.tcp_queries == 1, len(r.ans)
+    # too big for a client without EDNS
+    r = Record.unpack((yield ask('big.test')))
+    assert r.truncated and not r.ans and upstream.tcp_queries == 1
+    print('TC -> TCP fallback: ok')
+
+    # no answer after all retries
+    before = upstream.udp_queries
+    r = Record.unpack((yield ask('dead.test')))
+    assert r.rcode == 2 and upstream.udp_queries - before == f.retries + 1
+    assert not f._inflight and not f._pending
+    print('SERVFAIL after retries: ok')
+
+    # no more than max_inflight questions upstream
+    f.max_inflight = 2
+    futs = [ask('n%d.test' % i) for i in range(2)]
+    r = Record.unpack((yield ask('n2.test')))
+    assert r.rcode == 2 and f.stats()['overloaded'] == 1
+    assert len(f._pending) == 2
+    yield futs
+    print('max_inflight: ok')
+
+    # and over a real socket
+    port = f.listen(0, '127.0.0.1')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    got = Future()
+    ioloop.add_handler(sock.fileno(),
+                       lambda fd, events: got.set_result(sock.recv(65535)),
+                       ioloop.READ)
+    sock.sendto(mkquery(('a.test', TYPE.A)).pack(), ('127.0.0.1', port))
+    r = Record.unpack((yield gen.with_timeout(ioloop.time() + 2, got)))
+    assert r.ans[0][4] == '10.0.0.1'
+    ioloop.remove_handler(sock.fileno())
+    sock.close()
+    print('UDP listener: ok')
+
+    print(f.stats())
+    f.close()
+    upstream.close()
+
+  ioloop.run_sync(run)
+
 def test():
   import sys
   n = len(sys.argv) - 1
@@ -41,4 +568,8 @@ def test():
   ioloop.start()
 
 if __name__ == '__main__':
-  test()
+  import sys
+  if sys.argv[1:] == ['--selftest']:
+    selftest()
+  else:
+    test()
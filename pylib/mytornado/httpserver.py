@@ -5,7 +5,6 @@ import sys
 import re
 import datetime
 import stat
-import mimetypes
 import threading
 import email.utils
 import time
@@ -16,6 +15,8 @@ except ImportError:
   import httplib as httpclient
 import traceback
 import tempfile
+import errno
+import mmap
 from functools import partial
 
 from tornado.web import (
@@ -25,6 +26,9 @@ from tornado.web import (
 import tornado.web
 import tornado.escape
 import tornado.httpserver
+import tornado.ioloop
+import tornado.concurrent
+from tornado.iostream import SSLIOStream, StreamClosedError
 from tornado.log import app_log, gen_log
 try:
   from tornado.web import stream_request_body
@@ -32,9 +36,116 @@ try:
 except ImportError:
   _streaming_body = False
 
-from .util import FileEntry
-
-_legal_range = re.compile(r'bytes=(\d*)-(\d*)$')
+from .util import FileEntry, FileInfo
+
+_range_spec = re.compile(r'(\d*)-(\d*)$')
+_entity_tag = re.compile(r'\*|(?:W/)?"[^"]*"')
+
+def _parse_ranges(value, file_length):
+  '''parse the value of a Range header
+
+  Return a list of inclusive ``(start, stop)`` for the satisfiable ranges
+  (empty if there is none), or ``None`` if it is not a valid byte range set
+  and should be ignored.
+  '''
+  unit, sep, specs = value.partition('=')
+  if unit.strip() != 'bytes' or not sep:
+    return None
+  ranges = []
+  seen = False
+  for spec in specs.split(','):
+    spec = spec.strip()
+    if not spec:
+      continue
+    m = _range_spec.match(spec)
+    if not m or m.group(0) == '-':
+      return None
+    seen = True
+    start, stop = m.groups()
+    if start:
+      start = int(start)
+      if stop:
+        stop = int(stop)
+        if stop < start:
+          return None
+      if start >= file_length:
+        continue
+      stop = min(int(stop or file_length - 1), file_length - 1)
+    else:
+      # suffix: the last ``stop`` bytes
+      suffix = int(stop)
+      if suffix == 0 or file_length == 0:
+        continue
+      start = max(file_length - suffix, 0)
+      stop = file_length - 1
+    ranges.append((start, stop))
+  if not seen:
+    return None
+  return ranges
+
+def _coalesce_ranges(ranges):
+  '''sort ranges and merge the overlapping or adjacent ones'''
+  ranges = sorted(ranges)
+  merged = [ranges[0]]
+  for start, stop in ranges[1:]:
+    last_start, last_stop = merged[-1]
+    if start <= last_stop + 1:
+      merged[-1] = (last_start, max(stop, last_stop))
+    else:
+      merged.append((start, stop))
+  return merged
+
+def _etag_matches(value, etag):
+  '''whether ``etag`` is in the If-None-Match ``value`` (weak comparison)'''
+  if etag.startswith('W/'):
+    etag = etag[2:]
+  for tag in _entity_tag.findall(value):
+    if tag == '*':
+      return True
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == etag:
+      return True
+  return False
+
+def _accepted_encodings(value):
+  '''content codings accepted in the Accept-Encoding ``value``'''
+  accepted = set()
+  for item in value.split(','):
+    coding, _, params = item.partition(';')
+    coding = coding.strip().lower()
+    q = params.strip()
+    if q.startswith('q='):
+      try:
+        if float(q[2:]) <= 0:
+          continue
+      except ValueError:
+        continue
+    if coding == 'x-gzip':
+      coding = 'gzip'
+    if coding:
+      accepted.add(coding)
+  return accepted
+
+def _compressible_type(mime_type):
+  '''whether Tornado's ``GZipContentEncoding`` compresses ``mime_type``'''
+  if mime_type in GZipContentEncoding.CONTENT_TYPES:
+    return True
+  # since Tornado 4.0 all text/* types are compressed too
+  return hasattr(GZipContentEncoding, '_compressible_type') and \
+      mime_type.startswith('text/')
+
+def _parse_http_date(value):
+  '''parse an HTTP date into a naive local datetime; ``None`` if invalid'''
+  if value is None:
+    return None
+  date_tuple = email.utils.parsedate(value)
+  if date_tuple is None:
+    return None
+  try:
+    return datetime.datetime.fromtimestamp(time.mktime(date_tuple))
+  except (OverflowError, ValueError):
+    return None
 
 class ErrorHandlerMixin:
   '''nicer error page'''
@@ -93,7 +204,11 @@ class StaticFileHandler(RequestHandler):
   Why prefer this than the one in Tornado 3.1?
 
   1. Etag is not md5sum, so it's quick on large files;
-  2. Read file chunk by chunk, so it won't eat all your memory on huge files.
+  2. Read file chunk by chunk, so it won't eat all your memory on huge files;
+  3. Multiple byte ranges (sent as ``multipart/byteranges``) and ``If-Range``
+     are supported, so download managers and players can fetch segments.
+     Overlapping ranges are merged; if more than ``MAX_RANGES`` are left,
+     the whole file is sent.
 
   To map a path to this handler for a static data directory ``/var/www``,
   you would add a line to your application like::
@@ -103,12 +218,26 @@ class StaticFileHandler(RequestHandler):
         "path": "/var/www",
         "default_filenames": ["index.html"], #optional
         "dirindex": "dirlisting", #optional template name for directory listing
+        "file_cache": FileInfoCache(ttl=5), #optional, see below
       }),
     ])
 
   The local root directory of the content should be passed as the ``path``
   argument to the handler.
 
+  With ``precompressed`` set to content codings, e.g. ``('br', 'gzip')``, a
+  ``file.br`` or ``file.gz`` sibling that is not older than ``file`` is sent
+  instead to clients that accept it. With a ``compressed_cache`` (a
+  ``mytornado.util.CompressedCache``), compressible files are gzipped once in
+  the background and later requests get the cached copy. Either way the
+  response has a Content-Length and supports ranges of the compressed bytes,
+  and nothing is compressed per request.
+
+  With a ``file_cache`` (a ``mytornado.util.FileInfoCache``, shared by all
+  requests), what is found out about a path (stat results, MIME type, which
+  default filename to use and, with ``keep_open``, an open file) is reused
+  for a few seconds instead of being looked up on every request.
+
   The `dirindex` template will receive the following parameters:
     - `url`: the requested path
     - `files`, a list of ``FileEntry``; override ``FileEntry`` attribute to
@@ -120,21 +249,38 @@ class StaticFileHandler(RequestHandler):
   want browsers to cache a file indefinitely, send them to, e.g.,
   ``/static/images/myimage.png?v=xxx``. Override `get_cache_time` method for
   more fine-grained cache control.
+
+  When the response body is the file as is (no gzip), it is sent without
+  copying it through Python, with the methods listed in ``ZERO_COPY`` tried
+  in order:
+    - ``'sendfile'``: ``os.sendfile`` on the connection socket (not for SSL);
+    - ``'mmap'``: memoryviews of the mmapped file are handed to the stream.
+      Note that a file truncated while being sent this way crashes the
+      process with SIGBUS, so it's not enabled by default.
+  If none applies to a request, the file is read ``BLOCK_SIZE`` at a time.
   """
   CACHE_MAX_AGE = 86400 * 365 * 10  # 10 years
   BLOCK_SIZE = 40960 # 4096 is too slow; this value works great here
+  ZERO_COPY = ('sendfile',)
+  SENDFILE_SIZE = 1024 * 1024 # at most this many bytes per sendfile call
+  MMAP_CHUNK = 1024 * 1024
+  MAX_RANGES = 64 # more ranges than this (after merging) get the whole file
   FileEntry = FileEntry
 
   _static_hashes = {}
   _lock = threading.Lock()  # protects _static_hashes
 
-  def initialize(self, path=None, default_filenames=None, dirindex=None):
+  def initialize(self, path=None, default_filenames=None, dirindex=None,
+                 file_cache=None, precompressed=(), compressed_cache=None):
     if path is not None:
       self.root = os.path.abspath(path) + os.path.sep
     else:
       self.root = None
     self.default_filenames = default_filenames
     self.dirindex = dirindex
+    self.file_cache = file_cache
+    self.precompressed = precompressed
+    self.compressed_cache = compressed_cache
 
   @classmethod
   def reset(cls):
@@ -166,13 +312,16 @@ class StaticFileHandler(RequestHandler):
     If you use ``send_file`` directly and want to use another file as default
     index, you should set this parameter.
     '''
-    # we've found the file
-    found = False
     # use @asynchronous on a seperate method so that HTTPError won't get
     # messed up
     if path is None:
       path = self.request.path
-    if os.path.isdir(abspath):
+    if self.file_cache is not None:
+      info = self.file_cache.get(abspath, self.default_filenames)
+    else:
+      info = FileInfo(abspath, self.default_filenames)
+
+    if info.isdir:
       # need to look at the request.path here for when path is empty
       # but there is some prefix to the path that was already
       # trimmed by the routing
@@ -183,16 +332,8 @@ class StaticFileHandler(RequestHandler):
         self.redirect(redir, permanent=True)
         return
 
-      # check if we have a default available
-      if self.default_filenames is not None:
-        for i in self.default_filenames:
-          abspath_ = os.path.join(abspath, i)
-          if os.path.exists(abspath_):
-            abspath = abspath_
-            found = True
-            break
-
-      if not found:
+      # no default available
+      if info.path is None:
         # try dir listing
         if self.dirindex is not None:
           if not include_body:
@@ -202,10 +343,10 @@ class StaticFileHandler(RequestHandler):
         else:
           raise HTTPError(403, "Directory Listing Not Allowed")
 
-    if not os.path.exists(abspath):
+    if info.stat is None:
       # failed to figure out the file to send
       raise HTTPError(404)
-    if not os.path.isfile(abspath):
+    if not info.isfile:
       raise HTTPError(403, "%s is not a file", self.request.path)
 
     if download is not False:
@@ -216,25 +357,30 @@ class StaticFileHandler(RequestHandler):
       # See http://kb.mozillazine.org/Filenames_with_spaces_are_truncated_upon_download
       self.set_header('Content-Disposition', 'attachment; filename="%s"' % filename.replace('"', r'\"'))
 
-    self._send_file_async(path, abspath, include_body)
+    self._send_file_async(path, info, include_body)
 
   @asynchronous
-  def _send_file_async(self, path, abspath, include_body=True):
-    stat_result = os.stat(abspath)
+  def _send_file_async(self, path, info, include_body=True):
+    stat_result = info.stat
     modified = datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME])
     self.set_header("Last-Modified", modified)
     set_length = True
 
-    mime_type, encoding = mimetypes.guess_type(abspath)
-    if not mime_type:
-      # default is plain text
-      mime_type = 'text/plain'
+    mime_type = info.mime_type
     self.set_header("Content-Type", mime_type)
 
-    # make use of gzip when possible
-    if self.settings.get("gzip") and \
-        mime_type in GZipContentEncoding.CONTENT_TYPES:
+    # send a compressed copy if we have one, or else make use of gzip when
+    # possible
+    variant, coding = self._compressed_variant(info)
+    if variant is not None:
+      info, stat_result = variant, variant.stat
+      self.set_header('Content-Encoding', coding)
+    elif self.settings.get("gzip") and _compressible_type(mime_type):
       set_length = False
+    if (self.precompressed or self.compressed_cache is not None) and \
+       not self.settings.get("gzip"):
+      # with gzip on, GZipContentEncoding adds it
+      self.set_header('Vary', 'Accept-Encoding')
 
     file_length = stat_result[stat.ST_SIZE]
     if set_length:
@@ -248,48 +394,92 @@ class StaticFileHandler(RequestHandler):
                       datetime.timedelta(seconds=cache_time))
       self.set_header("Cache-Control", "max-age=" + str(cache_time))
 
+    etag = self.get_etag(stat_result)
+    if etag is not None:
+      if not set_length:
+        # the body may be gzipped, so it's not byte-for-byte the file
+        etag = 'W/' + etag
+      self.set_header('Etag', etag)
+
     self.set_extra_headers(path)
 
-    # Check the If-Modified-Since, and don't send the result if the
-    # content has not been modified
-    ims_value = self.request.headers.get("If-Modified-Since")
-    if ims_value is not None:
-      date_tuple = email.utils.parsedate(ims_value)
-      if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
-      if if_since >= modified:
-        self.set_status(304)
-        self.finish()
-        return
+    # Check the If-None-Match, or else the If-Modified-Since, and don't
+    # send the result if the content has not been modified
+    inm_value = self.request.headers.get("If-None-Match")
+    if inm_value is not None:
+      not_modified = etag is not None and _etag_matches(inm_value, etag)
+    else:
+      if_since = _parse_http_date(self.request.headers.get("If-Modified-Since"))
+      not_modified = if_since is not None and if_since >= modified
+    if not_modified:
+      self.set_status(304)
+      self.finish()
+      return
 
     # Check for range requests
     ranges = None
-    if set_length:
-      ranges = self.request.headers.get("Range")
+    range_value = self.request.headers.get("Range")
+    if set_length and range_value and self._if_range(etag, modified):
+      ranges = _parse_ranges(range_value, file_length)
+      if ranges == []:
+        self.set_status(416)
+        self.set_header('Content-Range', 'bytes */%d' % file_length)
+        self.set_header('Content-Length', 0)
+        self.finish()
+        return
       if ranges:
-        range_match = _legal_range.match(ranges)
-        if range_match:
-          start = range_match.group(1)
-          start = start and int(start) or 0
-          stop = range_match.group(2)
-          stop = stop and int(stop) or file_length-1
-          if start >= file_length:
-            raise HTTPError(416)
-          self.set_status(206)
-          self.set_header('Content-Range', '%d-%d/%d' % (
-            start, stop, file_length))
+        merged = _coalesce_ranges(ranges)
+        # don't send parts of the file more than once
+        if len(merged) < len(ranges):
+          ranges = merged
+        if len(ranges) > self.MAX_RANGES:
+          # not worth a part header each; send the whole file instead
+          ranges = None
+
+    parts = None
+    if ranges:
+      self.set_status(206)
+      if len(ranges) == 1:
+        start, stop = ranges[0]
+        self.set_header('Content-Range', 'bytes %d-%d/%d' % (
+          start, stop, file_length))
+        self.set_header("Content-Length", stop-start+1)
+      else:
+        boundary = os.urandom(12).hex()
+        parts = []
+        content_length = 0
+        for start, stop in ranges:
+          header = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                    'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                      boundary, mime_type, start, stop, file_length)
+                   ).encode('latin1')
+          parts.append((header, start, stop-start+1))
+          content_length += len(header) + stop-start+1
+        trailer = ('\r\n--%s--\r\n' % boundary).encode('latin1')
+        content_length += len(trailer)
+        self.set_header('Content-Type',
+                        'multipart/byteranges; boundary=' + boundary)
+        self.set_header("Content-Length", content_length)
 
     if not include_body:
       self.finish()
       return
 
-    file = open(abspath, "rb")
     if ranges:
-      if start:
-        file.seek(start, os.SEEK_SET)
-      self._write_chunk(file, length=stop-start+1)
+      offset, length = start, stop-start+1
     else:
-      self._write_chunk(file, length=file_length)
+      offset, length = 0, file_length
+
+    file = info.open()
     self.request.connection.stream.set_close_callback(partial(self._close_on_error, file))
+    if parts:
+      self._write_parts(file, iter(parts), trailer)
+      return
+    if set_length and self._send_zero_copy(file, offset, length):
+      return
+    if offset:
+      file.seek(offset, os.SEEK_SET)
+    self._write_chunk(file, length=length)
 
   def renderIndex(self, path):
     files = []
@@ -304,26 +494,207 @@ class StaticFileHandler(RequestHandler):
     self.render(self.dirindex, files=files, url=self.request.path,
                decodeURIComponent=tornado.escape.url_unescape)
 
-  def _write_chunk(self, file, length):
+  def _compressed_variant(self, info):
+    '''a ``FileInfo`` for a compressed copy of the file acceptable to the
+    client and its content coding, or ``(None, None)``'''
+    if not self.precompressed and self.compressed_cache is None:
+      return None, None
+    accepted = _accepted_encodings(self.request.headers.get('Accept-Encoding', ''))
+    for coding in self.precompressed:
+      if coding in accepted:
+        variant = info.precompressed(coding)
+        if variant is not None:
+          return variant, coding
+    if self.compressed_cache is not None and 'gzip' in accepted and \
+       _compressible_type(info.mime_type):
+      variant = self.compressed_cache.get(info)
+      if variant is not None:
+        return variant, 'gzip'
+    return None, None
+
+  def _write_chunk(self, file, length, callback=None):
     size = min(length, self.BLOCK_SIZE)
     left = length - size
     chunk = file.read(size)
     self.write(chunk)
     if left != 0:
-      cb = partial(self._write_chunk, file, length=left)
+      cb = partial(self._write_chunk, file, length=left, callback=callback)
+    elif callback is not None:
+      cb = callback
     else:
       cb = self.finish
       file.close()
     self.flush(callback=cb)
 
-  def _close_on_error(self, file):
-    gen_log.info('closing %d on connection close.', file.fileno())
+  def _write_parts(self, file, parts, trailer):
+    '''write a multipart/byteranges body one part after another'''
+    for header, start, length in parts:
+      self.write(header)
+      file.seek(start, os.SEEK_SET)
+      self._write_chunk(file, length, callback=partial(
+        self._write_parts, file, parts, trailer))
+      return
+    self.write(trailer)
     file.close()
+    self.finish()
+
+  def _if_range(self, etag, modified):
+    '''whether the Range header should be honored, according to If-Range'''
+    value = self.request.headers.get("If-Range")
+    if value is None:
+      return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+      # only strong validators count
+      return etag is not None and not etag.startswith('W/') and value == etag
+    return _parse_http_date(value) == modified
+
+  def _send_zero_copy(self, file, offset, length):
+    '''start sending the file with one of ``ZERO_COPY`` methods
+
+    Return ``False`` if none of them can be used for this request.
+    '''
+    if length == 0:
+      return False
+    stream = self.request.connection.stream
+    for method in self.ZERO_COPY:
+      if method == 'sendfile':
+        if not hasattr(os, 'sendfile') or isinstance(stream, SSLIOStream):
+          continue
+        if not hasattr(self.request.connection, '_expected_content_remaining'):
+          # a connection we don't know how to bypass; see _content_sent
+          continue
+        try:
+          # a separate fd so that we can wait for it to be writable without
+          # disturbing the IOStream's handler
+          fd = os.dup(stream.socket.fileno())
+        except (AttributeError, OSError):
+          continue
+        # [offset, bytes left, fd or None once closed]
+        state = [offset, length, fd]
+        stream.set_close_callback(partial(self._close_sendfile, file, state))
+        self.flush(callback=partial(self._start_sendfile, file, state))
+        return True
+      elif method == 'mmap':
+        try:
+          m = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+          continue
+        if len(m) < offset + length:
+          m.close()
+          continue
+        stream.set_close_callback(partial(self._close_on_error, file, m))
+        self.flush(callback=partial(
+          self._write_mmap_chunk, file, m, offset, offset + length))
+        return True
+    return False
+
+  def _start_sendfile(self, file, state):
+    if state[2] is None: # the connection is gone already
+      return
+    ioloop = tornado.ioloop.IOLoop.current()
+    ioloop.add_handler(state[2], partial(self._sendfile_chunk, file, state),
+                       ioloop.WRITE)
+
+  def _sendfile_chunk(self, file, state, fd, events):
+    offset, left, _ = state
+    if file.closed:
+      self._end_sendfile(state)
+      return
+    try:
+      sent = os.sendfile(fd, file.fileno(), offset,
+                         min(left, self.SENDFILE_SIZE))
+    except (BlockingIOError, InterruptedError):
+      return
+    except (OSError, ValueError) as e:
+      self._end_sendfile(state)
+      if isinstance(e, ValueError) or file.closed or \
+         e.errno in (errno.EPIPE, errno.ECONNRESET):
+        self.request.connection.stream.close()
+        return
+      # sendfile doesn't work here; send the rest the usual way
+      gen_log.info('sendfile failed (%s), falling back to read', e)
+      self._content_sent(left)
+      file.seek(offset, os.SEEK_SET)
+      self._write_chunk(file, length=left)
+      return
+
+    if sent == 0:
+      # the file has shrunk; we can't send as much as we promised
+      gen_log.warning('%s shrank while being sent', file.name)
+      self._end_sendfile(state)
+      self.request.connection.stream.close()
+      return
+
+    state[0] = offset + sent
+    state[1] = left - sent
+    if state[1] == 0:
+      self._end_sendfile(state)
+      self._content_sent(0)
+      file.close()
+      self.finish()
+
+  def _end_sendfile(self, state):
+    fd, state[2] = state[2], None
+    if fd is not None:
+      tornado.ioloop.IOLoop.current().remove_handler(fd)
+      os.close(fd)
+
+  def _close_sendfile(self, file, state):
+    self._end_sendfile(state)
+    self._close_on_error(file)
+
+  def _content_sent(self, left):
+    '''tell the connection that only ``left`` bytes of the body are still to
+    be written through it; the rest went out by sendfile
+
+    This sets the private ``HTTP1Connection._expected_content_remaining``
+    (checked against Tornado 4.0 to 6.x), which it counts down on writes
+    and checks in ``finish``. `_send_zero_copy` doesn't use sendfile on
+    connections without it.
+    '''
+    conn = self.request.connection
+    if getattr(conn, '_expected_content_remaining', None) is not None:
+      conn._expected_content_remaining = left
+
+  def _write_mmap_chunk(self, file, m, pos, end):
+    if pos < end:
+      n = min(end - pos, self.MMAP_CHUNK)
+      chunk = memoryview(m)[pos:pos+n]
+      self.request.connection.write(chunk, callback=partial(
+        self._write_mmap_chunk, file, m, pos + n, end))
+    else:
+      self._close_mmap(m)
+      file.close()
+      self.finish()
+
+  def _close_mmap(self, m):
+    try:
+      m.close()
+    except BufferError:
+      # the stream still holds a view; leave it to the garbage collector
+      pass
+
+  def _close_on_error(self, file, m=None):
+    if not file.closed:
+      gen_log.info('closing %d on connection close.', file.fileno())
+      file.close()
+    if m is not None:
+      self._close_mmap(m)
 
   def set_extra_headers(self, path):
     """For subclass to add extra headers to the response"""
     pass
 
+  def get_etag(self, stat_result):
+    """Override to customize the Etag; return ``None`` to send none.
+
+    By default it's made of the inode number, size and modification time of
+    the file, so it doesn't need to read the file.
+    """
+    return '"%x-%x-%x"' % (stat_result.st_ino, stat_result.st_size,
+                           stat_result.st_mtime_ns)
+
   def get_cache_time(self, path, modified, mime_type):
     """Override to customize cache control behavior.
 
@@ -382,6 +753,119 @@ def apache_style_log(handler):
   print(ip, '- -', dt, req, status, length, referrer, ua, file=f)
   f.flush()
 
+def benchmark_static(size=256*1024*1024, clients=4, requests=2,
+                     methods=((), ('sendfile',), ('mmap',))):
+  '''download a ``size``-byte file with ``clients`` concurrent clients, each
+  ``requests`` times, for each ``ZERO_COPY`` setting in ``methods``; print the
+  throughput and the CPU time the server spends per GB'''
+  from concurrent.futures import ThreadPoolExecutor
+  from tornado.netutil import bind_sockets
+
+  with tempfile.TemporaryDirectory() as d:
+    block = os.urandom(1024 * 1024)
+    with open(os.path.join(d, 'big.bin'), 'wb') as f:
+      for _ in range(size // len(block)):
+        f.write(block)
+
+    def client(port):
+      got = 0
+      buf = bytearray(256 * 1024)
+      for _ in range(requests):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(b'GET /big.bin HTTP/1.0\r\n\r\n')
+        while True:
+          n = s.recv_into(buf)
+          if not n:
+            break
+          got += n
+        s.close()
+      return got
+
+    for zero_copy in methods:
+      handler = type('Handler', (StaticFileHandler,), {'ZERO_COPY': zero_copy})
+      app = tornado.web.Application([(r'/(.*)', handler, {'path': d})])
+      server = tornado.httpserver.HTTPServer(app)
+      sockets = bind_sockets(0, '127.0.0.1')
+      server.add_sockets(sockets)
+      port = sockets[0].getsockname()[1]
+      ioloop = tornado.ioloop.IOLoop.current()
+
+      with ThreadPoolExecutor(clients) as executor:
+        futures = [executor.submit(client, port) for _ in range(clients)]
+        executor.submit(lambda: [f.result() for f in futures]).add_done_callback(
+          lambda f: ioloop.add_callback(ioloop.stop))
+        t = time.perf_counter()
+        cpu = time.thread_time() # the IOLoop runs in this thread
+        ioloop.start()
+        cpu = time.thread_time() - cpu
+        t = time.perf_counter() - t
+        total = sum(f.result() for f in futures)
+      server.stop()
+      for sock in sockets:
+        sock.close()
+
+      print('%-10s %8.1f MB/s %8.3f CPU s/GB' % (
+        ' '.join(zero_copy) or 'read', total / t / 1e6, cpu / (total / 1e9)))
+
+def benchmark_upload(size=512*1024*1024, chunk_size=65536):
+  '''upload a ``size``-byte file to a ``TmpFilesHandler`` over a local
+  connection, ``chunk_size`` bytes per send, and print the throughput and how
+  much the peak RSS grew'''
+  import resource
+  from tornado.netutil import bind_sockets
+
+  boundary = b'benchmarkboundary'
+  head = (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="f"; '
+          b'filename="big.bin"\r\nContent-Type: application/octet-stream\r\n\r\n')
+  tail = (b'\r\n--' + boundary + b'\r\nContent-Disposition: form-data; '
+          b'name="field"\r\n\r\nvalue\r\n--' + boundary + b'--\r\n')
+  result = {}
+
+  class Handler(TmpFilesHandler):
+    def post(self):
+      f = self.request.files['f'][0]
+      result['size'] = os.path.getsize(f.tmp_filename)
+      result['field'] = self.get_body_argument('field')
+      os.unlink(f.tmp_filename)
+      self.finish('ok')
+
+  def client(port):
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(b'POST / HTTP/1.1\r\nHost: localhost\r\n'
+              b'Content-Type: multipart/form-data; boundary=' + boundary +
+              b'\r\nContent-Length: %d\r\n\r\n' % (len(head) + size + len(tail)))
+    s.sendall(head)
+    block = os.urandom(chunk_size)
+    left = size
+    while left:
+      n = min(left, chunk_size)
+      s.sendall(block[:n])
+      left -= n
+    s.sendall(tail)
+    s.recv(4096)
+    s.close()
+    ioloop.add_callback(ioloop.stop)
+
+  app = tornado.web.Application([(r'/', Handler)])
+  server = HTTPServer(app)
+  sockets = bind_sockets(0, '127.0.0.1')
+  server.add_sockets(sockets)
+  ioloop = tornado.ioloop.IOLoop.current()
+
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  t = time.perf_counter()
+  threading.Thread(target=client, args=(sockets[0].getsockname()[1],)).start()
+  ioloop.start()
+  t = time.perf_counter() - t
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+  server.stop()
+  for sock in sockets:
+    sock.close()
+
+  assert result == {'size': size, 'field': 'value'}, result
+  # ru_maxrss is in KiB on Linux
+  print('%8.1f MB/s, peak RSS grew by %.1f MiB' % (size / t / 1e6, rss / 1024))
+
 def _on_content_headers(self, data, buf=b''):
   self._content_length_left -= len(data)
   data = self._boundary_buffer + data
@@ -451,52 +935,263 @@ def _read_into(self, fp, data, from_handler = False):
       # or we'll recurse too deep
       self._read_content_body(fp)
 
+class MultipartParser:
+  '''Incremental ``multipart/form-data`` parser
+
+  Feed it the request body piece by piece. File parts are written to
+  temporary files and added to ``request.files`` as ``HTTPFile`` objects
+  with a ``tmp_filename`` attribute; other fields are added to
+  ``request.body_arguments`` and ``request.arguments``. Only a delimiter's
+  length of unparsed data is kept between pieces, and each byte is looked at
+  once, however the body is split.
+
+  Malformed or too large input raises ``HTTPError``; call `discard` then,
+  or when the body doesn't complete, to remove the temporary files.
+  '''
+  max_header_size = 16384
+  max_field_size = 1024 * 1024
+
+  def __init__(self, boundary, request):
+    self._delimiter = b'\r\n--' + boundary
+    self._request = request
+    # as if a CRLF came before the body, so that the first boundary looks
+    # like all others and the preamble is just a part we don't keep
+    self._buf = bytearray(b'\r\n')
+    self._state = self._body
+    self._part = None
+    self._name = None
+    self._tmp_filenames = []
+    self.done = False
+
+  @classmethod
+  def from_request(cls, request):
+    '''a parser for ``request``, or ``None`` if it's not multipart/form-data'''
+    content_type = request.headers.get('Content-Type', '')
+    if not content_type.startswith('multipart/form-data'):
+      return None
+    for field in content_type.split(";"):
+      k, sep, v = field.strip().partition("=")
+      if k == "boundary" and v:
+        if v.startswith('"') and v.endswith('"'):
+          v = v[1:-1]
+        return cls(v.encode('latin1'), request)
+    return None
+
+  def feed(self, data):
+    self._buf += data
+    while not self.done and self._state():
+      pass
+
+  def close(self):
+    '''to be called at the end of the body'''
+    if not self.done:
+      gen_log.warning('multipart/form-data body ended without closing boundary')
+      self.done = True
+    self._end_part()
+
+  def discard(self):
+    '''stop parsing and delete the temporary files written so far'''
+    self.done = True
+    part, self._part = self._part, None
+    if part is not None and not isinstance(part, bytearray):
+      part.close()
+    for name in self._tmp_filenames:
+      try:
+        os.unlink(name)
+      except OSError:
+        pass
+    self._tmp_filenames = []
+    self._buf = bytearray()
+
+  def _body(self):
+    buf = self._buf
+    idx = buf.find(self._delimiter)
+    if idx == -1:
+      # keep what may be the start of a delimiter
+      n = len(buf) - len(self._delimiter) + 1
+      if n > 0:
+        self._write(buf, n)
+        del buf[:n]
+      return False
+    self._write(buf, idx)
+    del buf[:idx+len(self._delimiter)]
+    self._end_part()
+    self._state = self._after_boundary
+    return True
+
+  def _after_boundary(self):
+    buf = self._buf
+    if len(buf) < 2:
+      return False
+    if buf[:2] == b'--':
+      # the close delimiter; ignore the epilogue
+      self.done = True
+      del buf[:]
+      return False
+    # there may be transport padding before the CRLF
+    idx = buf.find(b'\r\n')
+    if idx == -1:
+      if len(buf) > self.max_header_size:
+        raise HTTPError(400, "Invalid multipart/form-data")
+      return False
+    del buf[:idx+2]
+    self._state = self._headers
+    return True
+
+  def _headers(self):
+    buf = self._buf
+    if buf[:2] == b'\r\n':
+      # no headers at all
+      idx, end = 0, 2
+    else:
+      idx = buf.find(b'\r\n\r\n')
+      end = idx + 4
+    if idx == -1:
+      if len(buf) > self.max_header_size:
+        raise HTTPError(400, "multipart/form-data headers too long")
+      return False
+    try:
+      header_data = bytes(buf[:idx]).decode('utf-8')
+    except UnicodeDecodeError:
+      raise HTTPError(400, "Invalid multipart/form-data headers")
+    del buf[:end]
+    self._start_part(header_data)
+    self._state = self._body
+    return True
+
+  def _start_part(self, header_data):
+    gen_log.debug('file header is %r', header_data)
+    headers = tornado.httputil.HTTPHeaders.parse(header_data)
+    disp_header = headers.get("Content-Disposition", "")
+    disposition, disp_params = tornado.httputil._parse_header(disp_header)
+    if disposition != "form-data":
+      gen_log.warning("Invalid multipart/form-data")
+      return
+    name = disp_params.get("name")
+    if not name:
+      gen_log.warning("multipart/form-data value missing name")
+      return
+    if disp_params.get("filename"):
+      ctype = headers.get("Content-Type", "application/unknown")
+      fd, tmp_filename = tempfile.mkstemp(suffix='.tmp', prefix='tornado')
+      self._tmp_filenames.append(tmp_filename)
+      self._request.files.setdefault(name, []).append(
+        tornado.httputil.HTTPFile(
+          filename=disp_params['filename'],
+          tmp_filename=tmp_filename,
+          content_type=ctype,
+        )
+      )
+      self._part = os.fdopen(fd, 'wb')
+    else:
+      self._part = bytearray()
+      self._name = name
+
+  def _write(self, buf, n):
+    part = self._part
+    if part is None or n == 0:
+      return
+    if isinstance(part, bytearray):
+      if len(part) + n > self.max_field_size:
+        raise HTTPError(413, "multipart/form-data field %s too large", self._name)
+      part += buf[:n]
+    else:
+      with memoryview(buf) as view, view[:n] as data:
+        part.write(data)
+
+  def _end_part(self):
+    part, self._part = self._part, None
+    if part is None:
+      return
+    if isinstance(part, bytearray):
+      value = bytes(part)
+      request = self._request
+      request.body_arguments.setdefault(self._name, []).append(value)
+      request.arguments.setdefault(self._name, []).append(value)
+    else:
+      part.close()
+
 if _streaming_body:
 
   @stream_request_body
   class TmpFilesHandler(RequestHandler):
-    _boundary = None
-    _buffer = b''
-    _reading_body_into = None
-    _reading_headers = False
+    '''Handler for big uploads
 
-    def data_received(self, chunk):
-      self._buffer += chunk
-
-      if self._boundary is None and self.request.method in ("POST", "PUT"):
-        self._request = self.request
-        content_type = self.request.headers.get('Content-Type', '')
-        if content_type.startswith('multipart/form-data'):
-          self._content_length_left = int(
-            self.request.headers.get('Content-Length'))
-          fields = content_type.split(";")
-          for field in fields:
-            k, sep, v = field.strip().partition("=")
-            if k == "boundary" and v:
-              if v.startswith('"') and v.endswith('"'):
-                v = v[1:-1]
-              self._boundary = b'--' + v.encode('latin1')
-              self._boundary_buffer = b''
-              self._boundary_len = len(self._boundary)
-              break
+    ``multipart/form-data`` bodies are parsed as they arrive by a
+    ``MultipartParser``, so files go to temporary files (see there). Other
+    bodies are collected and parsed as usual.
 
-      if self._boundary:
-        if self._reading_headers:
-          pos = self._buffer.find(b'\r\n\r\n')
-          if pos != -1:
-            self._reading_headers = False
-            _on_content_headers(self, self._buffer[:pos])
-            self._buffer = self._buffer[pos:]
-        else:
-          self._read_content_body(self._reading_body_into)
+    A body the parser rejects is answered with its error status (e.g. 413
+    for a too large field) without calling the HTTP method, and the
+    temporary files of a body that doesn't complete are deleted.
+    '''
+    MultipartParser = MultipartParser
+    _parser = None
+    _body = None
 
-      if self._buffer:
-        self.data_received(b'')
+    def prepare(self):
+      '''subclasses overriding this must call it'''
+      # in streaming mode request.body is a Future resolved once the whole
+      # body (with or without a Content-Length) has arrived, before the
+      # HTTP method is called
+      self.request.body.add_done_callback(self._end_of_body)
 
-    def _read_content_body(self, fp):
-      data = self._buffer
-      self._buffer = b''
-      _read_into(self, fp, data, from_handler = True)
+    def data_received(self, chunk):
+      if self._finished:
+        return
+      if self._parser is None and self._body is None:
+        if self.request.method in ("POST", "PUT"):
+          self._parser = self.MultipartParser.from_request(self.request)
+        if self._parser is None:
+          self._body = bytearray()
+
+      if self._parser is not None:
+        try:
+          self._parser.feed(chunk)
+        except HTTPError as e:
+          self._reject_body(e)
+      else:
+        self._body += chunk
+
+    def _reject_body(self, e):
+      self.log_exception(*sys.exc_info())
+      self._parser.discard()
+      self._parser = None
+      # _execute waits on the original Future before calling the HTTP
+      # method; fail it like a closed connection would, and leave a new one
+      # for tornado to resolve at the end of the body
+      body, self.request.body = self.request.body, tornado.concurrent.Future()
+      body.set_exception(StreamClosedError())
+      body.exception() # retrieved, so not logged
+      self.send_error(e.status_code, exc_info=sys.exc_info())
+
+    def _end_of_body(self, future):
+      if future.cancelled() or future.exception() is not None:
+        # the connection is gone or the body was rejected; the temporary
+        # files are removed by on_connection_close or _reject_body
+        return
+      if self._parser is not None:
+        self._parser.close()
+        self._parser = None
+        # the content went to the parser; don't leave the Future here
+        self.request.body = b''
+      else:
+        request = self.request
+        request.body = bytes(self._body or b'')
+        self._body = None
+        tornado.httputil.parse_body_arguments(
+          request.headers.get("Content-Type", ""), request.body,
+          request.body_arguments, request.files, request.headers)
+        for k, v in request.body_arguments.items():
+          request.arguments.setdefault(k, []).extend(v)
+
+    def on_connection_close(self):
+      # the parser is dropped once the body is complete, so this is an
+      # unfinished upload
+      if self._parser is not None:
+        self._parser.discard()
+        self._parser = None
+      super().on_connection_close()
 
   class HTTPServer(tornado.httpserver.HTTPServer):
     def __init__(self, *args, **kwargs):
@@ -504,6 +1199,12 @@ if _streaming_body:
         kwargs['max_body_size'] = sys.maxsize
       super().__init__(*args, **kwargs)
 
+    def initialize(self, *args, **kwargs):
+      # since Tornado 4.1 the arguments go here rather than to __init__
+      if 'max_body_size' not in kwargs:
+        kwargs['max_body_size'] = sys.maxsize
+      super().initialize(*args, **kwargs)
+
 else:
 
   class TmpFilesHandler(RequestHandler):
@@ -2,6 +2,14 @@ import os
 import stat
 import datetime
 import re
+import time
+import mimetypes
+import threading
+import hashlib
+import gzip
+import shutil
+import weakref
+from collections import OrderedDict
 
 class FileEntry:
   '''For ``StaticFileHandler`` with directory index enabled'''
@@ -26,3 +34,339 @@ class FileEntry:
 def routes_adjust_prefix(routers, prefix):
   p = re.escape(prefix)
   return [tuple([p+r] + list(args)) for r, *args in routers]
+
+class FileInfo:
+  '''What ``StaticFileHandler`` needs to know about a requested path
+
+  ``path`` is the file to send: the requested path itself, or the first of
+  the default filenames found in it if it's a directory. It's ``None`` for a
+  directory without one of them. ``stat`` is the ``os.stat`` result of
+  ``path``, or ``None`` if it doesn't exist.
+  '''
+  _fd = None
+  _variants = None
+
+  # file name suffixes of precompressed siblings
+  suffixes = {'gzip': '.gz', 'br': '.br'}
+
+  def __init__(self, abspath, default_filenames=None):
+    self.isdir = False
+    self.path = abspath
+    try:
+      st = os.stat(abspath)
+    except OSError:
+      st = None
+    if st is not None and stat.S_ISDIR(st.st_mode):
+      self.isdir = True
+      self.path = None
+      st = None
+      for i in default_filenames or ():
+        path = os.path.join(abspath, i)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        self.path = path
+        break
+    self.stat = st
+
+    if self.path is not None:
+      mime_type, self.encoding = mimetypes.guess_type(self.path)
+      # default is plain text
+      self.mime_type = mime_type or 'text/plain'
+
+  @property
+  def isfile(self):
+    return self.stat is not None and stat.S_ISREG(self.stat.st_mode)
+
+  def precompressed(self, encoding):
+    '''``FileInfo`` of the sibling compressed with ``encoding`` (e.g.
+    ``file.js.gz`` for ``gzip``), if there is one not older than the file'''
+    if self._variants is None:
+      self._variants = {}
+    if encoding not in self._variants:
+      variant = None
+      suffix = self.suffixes.get(encoding)
+      if suffix is not None and self.isfile:
+        variant = FileInfo(self.path + suffix)
+        if not variant.isfile or variant.stat.st_mtime < self.stat.st_mtime:
+          variant = None
+        elif self._fd is not None:
+          variant.keep_open()
+      self._variants[encoding] = variant
+    return self._variants[encoding]
+
+  def keep_open(self):
+    '''keep the file open so that ``open`` doesn't need to open it again'''
+    if self.isfile and hasattr(os, 'pread'):
+      try:
+        self._fd = _SharedFd(os.open(self.path, os.O_RDONLY))
+      except OSError:
+        pass
+
+  def open(self):
+    '''open the file for reading'''
+    if self._fd is not None:
+      return SharedFile(self._fd, self.path)
+    return open(self.path, 'rb')
+
+  def release(self):
+    '''drop the kept-open file; files opened from it remain usable'''
+    if self._fd is not None:
+      self._fd.release()
+      self._fd = None
+    for variant in (self._variants or {}).values():
+      if variant is not None:
+        variant.release()
+
+class _SharedFd:
+  '''a file descriptor that is closed when its last user releases it'''
+  def __init__(self, fd):
+    self.fd = fd
+    self.refs = 1
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    with self._lock:
+      self.refs += 1
+
+  def release(self):
+    with self._lock:
+      self.refs -= 1
+      if self.refs == 0:
+        os.close(self.fd)
+
+class SharedFile:
+  '''A read-only file object on a file descriptor shared with other
+  requests, each with its own position (reads use ``os.pread``)'''
+  closed = False
+
+  def __init__(self, shared_fd, name):
+    shared_fd.acquire()
+    self._shared_fd = shared_fd
+    self.name = name
+    self._pos = 0
+
+  def fileno(self):
+    return self._shared_fd.fd
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_SET:
+      self._pos = offset
+    elif whence == os.SEEK_CUR:
+      self._pos += offset
+    else:
+      self._pos = os.fstat(self.fileno()).st_size + offset
+    return self._pos
+
+  def tell(self):
+    return self._pos
+
+  def read(self, size):
+    data = os.pread(self.fileno(), size, self._pos)
+    self._pos += len(data)
+    return data
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self._shared_fd.release()
+
+class FileInfoCache:
+  '''A bounded cache of ``FileInfo`` for ``StaticFileHandler``, so that hot
+  files skip the ``stat`` calls, ``mimetypes`` lookup and, with
+  ``keep_open``, opening the file.
+
+  Entries are trusted for ``ttl`` seconds, so changes to the files show up
+  after at most that long. At most ``maxsize`` paths are kept, evicting the
+  least recently used. ``hits``, ``misses`` and ``evictions`` are counters;
+  ``stats()`` returns all of them.
+  '''
+  def __init__(self, maxsize=1024, ttl=5, keep_open=False):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.keep_open = keep_open
+    self._lock = threading.Lock()
+    self._cache = OrderedDict()
+    self.hits = self.misses = self.evictions = 0
+
+  def clear(self):
+    with self._lock:
+      for _, info in self._cache.values():
+        info.release()
+      self._cache = OrderedDict()
+      self.hits = self.misses = self.evictions = 0
+
+  def get(self, abspath, default_filenames=None):
+    key = abspath, tuple(default_filenames or ())
+    now = time.monotonic()
+    with self._lock:
+      entry = self._cache.get(key)
+      if entry is not None and entry[0] > now:
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return entry[1]
+      self.misses += 1
+
+    info = FileInfo(abspath, default_filenames)
+    if self.keep_open:
+      info.keep_open()
+
+    with self._lock:
+      old = self._cache.pop(key, None)
+      if old is not None:
+        old[1].release()
+      elif len(self._cache) >= self.maxsize:
+        _, (_, evicted) = self._cache.popitem(last=False)
+        evicted.release()
+        self.evictions += 1
+      self._cache[key] = now + self.ttl, info
+    return info
+
+  def stats(self):
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        'size': len(self._cache),
+        'maxsize': self.maxsize,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': self.hits / total if total else 0.0,
+      }
+
+  def __len__(self):
+    return len(self._cache)
+
+class CompressedCache:
+  '''Gzipped copies of static files for ``StaticFileHandler``
+
+  A copy is made in a background thread the first time a file is asked
+  for, and served from then on. Copies live in ``directory`` and take at most
+  about ``max_size`` bytes; the least recently used ones are removed as new
+  ones are added. A copy handed out by ``get`` stays readable (through a
+  kept-open descriptor) even if it is removed before the handler is done.
+  They are named after the path, inode, size and modification time of the
+  file, so a changed file gets a new copy and the old one ages out. Files
+  smaller than ``min_size`` are not worth it and are left alone.
+  '''
+  suffix = '.gz'
+
+  def __init__(self, directory, max_size=256*1024*1024, level=6,
+               min_size=1024, executor=None):
+    if executor is None:
+      from concurrent.futures import ThreadPoolExecutor
+      executor = ThreadPoolExecutor(1)
+    self.directory = directory
+    self.max_size = max_size
+    self.level = level
+    self.min_size = min_size
+    self._executor = executor
+    self._lock = threading.Lock()
+    self._pending = set()
+    self.hits = self.misses = 0
+
+    os.makedirs(directory, exist_ok=True)
+    # name -> size, least recently used first
+    self._entries = OrderedDict()
+    # name -> FileInfo, made on first use
+    self._infos = {}
+    self._total = 0
+    files = []
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      if name.endswith(self.suffix):
+        st = os.stat(path)
+        files.append((st.st_mtime, name, st.st_size))
+      elif self.suffix + '.tmp' in name:
+        # left over by an interrupted compression
+        os.unlink(path)
+    for _, name, size in sorted(files):
+      self._entries[name] = size
+      self._total += size
+
+  def _name(self, info):
+    st = info.stat
+    key = '%s\0%d\0%d\0%d' % (info.path, st.st_ino, st.st_size, st.st_mtime_ns)
+    return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest() \
+        + self.suffix
+
+  def get(self, info):
+    '''``FileInfo`` of the compressed copy of the file ``info`` is about, or
+    ``None`` if there is none yet (one is being made then)'''
+    if info.stat.st_size < self.min_size:
+      return None
+    name = self._name(info)
+    with self._lock:
+      if name not in self._entries:
+        self.misses += 1
+        if name not in self._pending:
+          self._pending.add(name)
+          self._executor.submit(self._compress, info.path, name)
+        return None
+      self.hits += 1
+      self._entries.move_to_end(name)
+      variant = self._infos.get(name)
+      if variant is None:
+        variant = self._open(name)
+        if not variant.isfile:
+          # removed behind our back; make it again next time
+          self._total -= self._entries.pop(name)
+          return None
+        self._infos[name] = variant
+    return variant
+
+  def _open(self, name):
+    info = FileInfo(os.path.join(self.directory, name))
+    info.keep_open()
+    if info._fd is not None:
+      # the copy stays readable until whoever got it from get() is done,
+      # even if it's evicted in the meantime
+      weakref.finalize(info, info._fd.release)
+    return info
+
+  def _compress(self, path, name):
+    dest = os.path.join(self.directory, name)
+    tmp = '%s.tmp%d' % (dest, threading.get_ident())
+    size = None
+    try:
+      with open(path, 'rb') as f, open(tmp, 'wb') as out:
+        with gzip.GzipFile('', 'wb', self.level, out, mtime=0) as gz:
+          shutil.copyfileobj(f, gz, 64 * 1024)
+      os.replace(tmp, dest)
+      size = os.path.getsize(dest)
+    except OSError:
+      try:
+        os.unlink(tmp)
+      except OSError:
+        pass
+    finally:
+      with self._lock:
+        self._pending.discard(name)
+        if size is not None:
+          self._entries[name] = size
+          self._total += size
+          self._evict()
+
+  def _evict(self):
+    # keep the newest one, which was just added
+    while self._total > self.max_size and len(self._entries) > 1:
+      name, size = self._entries.popitem(last=False)
+      self._infos.pop(name, None)
+      self._total -= size
+      try:
+        os.unlink(os.path.join(self.directory, name))
+      except OSError:
+        pass
+
+  def stats(self):
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        'size': len(self._entries),
+        'bytes': self._total,
+        'max_size': self.max_size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / total if total else 0.0,
+      }